@@ -3,12 +3,315 @@ Holds the functions for binning the dataset by age.
 """
 import numpy as np
 
+from common.resampling import get_equal_size_bin_indices, get_subsample_indices
+
 BIN_LABELS = ["All", "Bin 1", "Bin 2", "Bin 3"]
 ONLY_BIN_LABELS = ["Bin 1", "Bin 2", "Bin 3"]
 EQUAL_BIN_LABELS = ["Bin 1", "Bin 2 Equal", "Bin 3"]
+# Upper (inclusive) age edges between bins, by number of bins
+AGE_BIN_EDGES = {
+    2: (10,),
+    3: (9, 12),
+}
+
+
+class AgeBin:
+    """
+    Class describing an age bin by its label and the indices of its samples
+    in the full dataset, without copying the samples.
+
+    Use take() or materialize() to get the bin's samples when they're needed,
+    and get_bin_cv_splits() to cross-validate on the full dataset.
+    """
+    __slots__ = ('label', 'indices', 'is_all')
+
+    def __init__(self, label, indices, is_all=False):
+        """
+        Initializes the class with the bin's label and sample indices.
+
+        Parameters
+        ----------
+        label : str
+        indices : np.array
+            Integer indices of the bin's samples in the full dataset.
+        is_all : bool, optional
+            Whether the bin is the full dataset (in order), so taking its
+            samples doesn't copy them.
+
+        """
+        self.label = label
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.is_all = is_all
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return f'AgeBin({self.label!r}, n={len(self)})'
+
+    def take(self, array):
+        """
+        Gets the bin's rows of an array (E.g. X, y, or ages).
+
+        Parameters
+        ----------
+        array : np.array or pd.DataFrame
+
+        Returns
+        -------
+        np.array or pd.DataFrame
+            The array itself for the full dataset, otherwise a copy of the
+            bin's rows.
 
+        """
+        if self.is_all:
+            return array
 
-def get_age_bins_indices(ages, num_bins):
+        if hasattr(array, 'iloc'):
+            return array.iloc[self.indices]
+
+        return array[self.indices]
+
+    def materialize(self, X, y):
+        """
+        Gets the bin's samples and targets.
+
+        Parameters
+        ----------
+        X : np.array
+        y : np.array
+
+        Returns
+        -------
+        tuple
+            The bin's samples and targets.
+
+        """
+        return self.take(X), self.take(y)
+
+
+def get_age_bins(ages=None, n_samples=None, include_all=False, num_bins=3,
+                 edges=None, quantiles=None):
+    """
+    Gets the age bins as AgeBin descriptors (label and sample indices)
+    instead of copies of the samples.
+
+    Parameters
+    ----------
+    ages : np.array, optional
+        List of participant ages, the only bin is the full dataset if not
+        given.
+    n_samples : int, optional
+        Number of samples, needed if ages isn't given.
+    include_all : bool, optional
+        Whether to add the full dataset as the first bin ('All').
+    num_bins : int, optional
+    edges : list, optional
+        See get_age_bin_codes().
+    quantiles : int, optional
+        See get_age_bin_codes().
+
+    Returns
+    -------
+    list
+        List of AgeBin, in the same order as bin_data().
+
+    Examples
+    --------
+    >>> age_bins = get_age_bins(ages, include_all=True)
+    >>> [(age_bin.label, len(age_bin)) for age_bin in age_bins]
+    [('All', 373), ('Bin 1', 114), ('Bin 2', 147), ('Bin 3', 112)]
+    >>> X_bin, y_bin = age_bins[1].materialize(X, y)
+
+    """
+    if ages is None or not ages.any():
+        n_samples = n_samples if ages is None else len(ages)
+        return [AgeBin('All', np.arange(n_samples), is_all=True)]
+
+    age_bins = []
+    if include_all:
+        age_bins.append(AgeBin('All', np.arange(len(ages)), is_all=True))
+
+    bin_indices = get_age_bins_indices(ages, num_bins, edges, quantiles)
+    for bin_num, bin_index in enumerate(bin_indices, start=1):
+        age_bins.append(AgeBin(f'Bin {bin_num}', bin_index[0]))
+
+    return age_bins
+
+
+def get_bin_cv_splits(age_bin, cv, y=None):
+    """
+    Gets the cross-validation splits of an age bin as indices into the full
+    dataset.
+
+    The splits can be passed as the cv of sklearn's cross_validate() (or
+    similar) with the full X and y, so only each fold's samples are copied
+    instead of the whole bin.
+
+    Parameters
+    ----------
+    age_bin : AgeBin
+    cv : sklearn.cross_validation instance
+    y : np.array, optional
+        The full dataset's targets, for stratified splitters.
+
+    Returns
+    -------
+    list
+        A list containing all cross-validation folds (train, test).
+
+    Examples
+    --------
+    >>> for age_bin in get_age_bins(ages, include_all=True):
+    ...     bin_cv = get_bin_cv_splits(age_bin, RKF_10_10)
+    ...     scores = cross_validate(pipe, X, y, cv=bin_cv)
+
+    """
+    y_bin = None if y is None else age_bin.take(y)
+
+    return [(age_bin.indices[train], age_bin.indices[test])
+            for train, test in cv.split(age_bin.indices, y_bin)]
+
+
+def get_age_bin_codes(ages, num_bins=3, edges=None, quantiles=None):
+    """
+    Assigns every participant to an age bin in one vectorized pass.
+
+    Bins include their upper edge, so with the default edges of 3 bins
+    (9, 12) the bins are ages <= 9, 9 < ages <= 12, and 12 < ages.
+    Participants with a missing (NaN) or infinite age get no bin.
+
+    Parameters
+    ----------
+    ages : np.array
+        List of participant ages.
+    num_bins : int, optional
+        Number of age bins, used to look up the edges in AGE_BIN_EDGES if
+        edges and quantiles aren't given.
+    edges : list, optional
+        Upper (inclusive) age edges between the bins, in increasing order.
+    quantiles : int, optional
+        Number of bins of (approximately) equal size to split the ages into,
+        using the age quantiles as edges.
+
+    Returns
+    -------
+    codes : np.array
+        The age bin (0 to number of bins - 1) of each participant, -1 for a
+        non-finite age.
+    edges : np.array
+        The edges used.
+
+    Examples
+    --------
+    >>> codes, edges = get_age_bin_codes(ages, edges=(8, 10, 12, 14))
+    >>> np.bincount(codes[codes >= 0], minlength=len(edges) + 1)
+    array([ 71, 102,  86,  68,  46])
+
+    """
+    ages = np.asarray(ages)
+
+    if quantiles is not None:
+        edges = get_quantile_age_bin_edges(ages, quantiles)
+    elif edges is None:
+        if num_bins not in AGE_BIN_EDGES:
+            raise ValueError(f'No default age bin edges for '
+                             f'num_bins={num_bins}, pass edges or quantiles '
+                             f'instead')
+        edges = AGE_BIN_EDGES[num_bins]
+
+    edges = np.asarray(edges, dtype=np.float64)
+    if np.any(np.diff(edges) <= 0):
+        raise ValueError(f'Age bin edges must be increasing, got {edges}')
+
+    codes = np.searchsorted(edges, ages, side='left')
+    codes[~np.isfinite(ages)] = -1
+
+    return codes, edges
+
+
+def get_quantile_age_bin_edges(ages, quantiles):
+    """
+    Gets the age edges that split the participants into bins of
+    (approximately) equal size.
+
+    Parameters
+    ----------
+    ages : np.array
+    quantiles : int
+        Number of bins.
+
+    Returns
+    -------
+    np.array
+        The quantiles - 1 upper (inclusive) edges between the bins, ignoring
+        missing (NaN) ages.
+
+    """
+    return np.nanquantile(ages, np.linspace(0, 1, quantiles + 1)[1:-1])
+
+
+def get_sliding_windows(ages, window_size=3, step=1, min_age=None,
+                        max_age=None):
+    """
+    Gets sliding age windows as AgeBin descriptors, sorting the ages once.
+
+    Window i covers min_age + i * step <= age < min_age + i * step +
+    window_size. Since the subjects are sorted by age, each window is a
+    contiguous run of the sorted order, so consecutive windows only differ
+    by the subjects entering and leaving at the ends.
+
+    Parameters
+    ----------
+    ages : np.array
+    window_size : float, optional
+        Width of each window in years.
+    step : float, optional
+        Years between the start of consecutive windows.
+    min_age : float, optional
+        Start of the first window, defaults to the youngest age rounded down.
+    max_age : float, optional
+        Windows end at or before this age, defaults to the oldest age rounded
+        down plus one.
+
+    Returns
+    -------
+    windows : list
+        List of AgeBin labelled by their age range (E.g. '6-9'), with the
+        indices of each window in age order.
+    window_bounds : np.array
+        The start and end of each window in the age-sorted order (windows x
+        2), so window i is order[start:end] where order sorts the ages.
+
+    Examples
+    --------
+    >>> windows, _ = get_sliding_windows(ages, window_size=2, step=0.5)
+    >>> windows[:2]
+    [AgeBin('6-8', n=95), AgeBin('6.5-8.5', n=101)]
+
+    """
+    ages = np.asarray(ages)
+    min_age = np.floor(ages.min()) if min_age is None else min_age
+    max_age = np.floor(ages.max()) + 1 if max_age is None else max_age
+
+    n_windows = int(np.floor(
+        (max_age - min_age - window_size) / step + 1e-9)) + 1
+    starts = min_age + step * np.arange(max(n_windows, 0))
+
+    order = np.argsort(ages, kind='stable')
+    sorted_ages = ages[order]
+    window_bounds = np.stack([
+        np.searchsorted(sorted_ages, starts, side='left'),
+        np.searchsorted(sorted_ages, starts + window_size, side='left')],
+        axis=1)
+
+    windows = [AgeBin(f'{start:g}-{start + window_size:g}', order[lo:hi])
+               for start, (lo, hi) in zip(starts, window_bounds)]
+
+    return windows, window_bounds
+
+
+def get_age_bins_indices(ages, num_bins=3, edges=None, quantiles=None):
     """
     Gets the indices that bins the participant by age.
 
@@ -20,32 +323,32 @@ def get_age_bins_indices(ages, num_bins):
     ----------
     ages : np.array
         List of participant ages.
-    num_bins : int
+    num_bins : int, optional
         Number of age bins.
+    edges : list, optional
+        See get_age_bin_codes().
+    quantiles : int, optional
+        See get_age_bin_codes().
 
     Returns
     -------
     bin_indices : list
-        List where the length is num_bins and each element is a list of
-        indices for each age bin.
+        List where the length is the number of bins and each element is a
+        tuple containing the array of indices for each age bin, like
+        np.where(). Participants with a non-finite age are in no bin.
 
     """
-    bin_indices = []
+    codes, edges = get_age_bin_codes(ages, num_bins, edges, quantiles)
 
-    if num_bins == 3:
-        bin_1 = np.where(ages <= 9)
-        bin_2 = np.where(np.logical_and(9 < ages, ages <= 12))
-        bin_3 = np.where(12 < ages)
-        bin_indices = [bin_1, bin_2, bin_3]
-    elif num_bins == 2:
-        bin_1 = np.where(ages <= 10)
-        bin_2 = np.where(10 < ages)
-        bin_indices = [bin_1, bin_2]
+    # Group the indices by bin with one sort, keeping them in order in a bin,
+    # the participants without a bin (code -1) sort first and are dropped
+    order = np.argsort(codes, kind='stable')
+    bin_starts = np.searchsorted(codes[order], np.arange(len(edges) + 1))
 
-    return bin_indices
+    return [(bin_index,) for bin_index in np.split(order, bin_starts)[1:]]
 
 
-def bin_by_age(X, y, ages, num_bins):
+def bin_by_age(X, y, ages, num_bins, edges=None, quantiles=None):
     """
     Bins the data by age.
 
@@ -55,6 +358,10 @@ def bin_by_age(X, y, ages, num_bins):
     y : np.array
     ages : np.array
     num_bins : int
+    edges : list, optional
+        See get_age_bin_codes().
+    quantiles : int, optional
+        See get_age_bin_codes().
 
     Returns
     -------
@@ -68,7 +375,7 @@ def bin_by_age(X, y, ages, num_bins):
     Typically bins the data into three age bins: 6-8, 9-11, and 12-16.
 
     """
-    bin_indices = get_age_bins_indices(ages, num_bins)
+    bin_indices = get_age_bins_indices(ages, num_bins, edges, quantiles)
 
     if y.ndim == 1:
         bins = [(X[bin_index], y[bin_index]) for bin_index in bin_indices]
@@ -78,12 +385,14 @@ def bin_by_age(X, y, ages, num_bins):
     return bins
 
 
-def bin_data(X, y, ages=None, include_all=False, num_bins=3):
+def bin_data(X, y, ages=None, include_all=False, num_bins=3, edges=None,
+             quantiles=None):
     """
     Bins the data by age or returns the original data.
 
     Used to wrap the bin_by_age() function when running multiple modeling
-    sessions.
+    sessions. This copies every bin's samples, use get_age_bins() to get
+    the bins as indices instead.
 
     Parameters
     ----------
@@ -92,6 +401,10 @@ def bin_data(X, y, ages=None, include_all=False, num_bins=3):
     ages : np.array, optional
     include_all : bool, optional
     num_bins : int, optional
+    edges : list, optional
+        See get_age_bin_codes().
+    quantiles : int, optional
+        See get_age_bin_codes().
 
     Returns
     -------
@@ -99,31 +412,18 @@ def bin_data(X, y, ages=None, include_all=False, num_bins=3):
         A tuple containing the samples, targets, and bin labels
 
     """
-    if ages is not None and ages.any():
-        bins = bin_by_age(X, y, ages, num_bins)
-
-        X_bins, y_bins, bin_labels = [], [], []
-
-        if include_all:
-            X_bins.append(X)
-            y_bins.append(y)
-            bin_labels.append('All')
+    age_bins = get_age_bins(ages, len(X), include_all, num_bins, edges,
+                            quantiles)
 
-        for bin_num, age_bin in enumerate(bins, start=1):
-            X_bins.append(age_bin[0])
-            y_bins.append(age_bin[1])
-            bin_labels.append(f'Bin {bin_num}')
-
-    else:
-        X_bins = [X]
-        y_bins = [y]
-        bin_labels = ["All"]
+    X_bins = [age_bin.take(X) for age_bin in age_bins]
+    y_bins = [age_bin.take(y) for age_bin in age_bins]
+    bin_labels = [age_bin.label for age_bin in age_bins]
 
     return (np.array(X_bins, dtype=object), np.array(y_bins, dtype=object),
             np.array(bin_labels, dtype=object))
 
 
-def subsample_bin(X_bin, y_bin, num_samples):
+def subsample_bin(X_bin, y_bin, num_samples, random_state=None):
     """
     Subsamples an age bin randomly for the given number of samples.
     
@@ -132,6 +432,7 @@ def subsample_bin(X_bin, y_bin, num_samples):
     X_bin : np.array
     y_bin : np.array
     num_samples : int
+    random_state : int or np.random.Generator, optional
 
     Returns
     -------
@@ -139,7 +440,8 @@ def subsample_bin(X_bin, y_bin, num_samples):
         A tuple containing the subsampled X and y
     
     """
-    subsample_indices = np.random.choice(X_bin.shape[0], num_samples, replace=False)
+    subsample_indices = get_subsample_indices(X_bin.shape[0], num_samples,
+                                              random_state=random_state)[0]
     
     return X_bin[subsample_indices], y_bin[subsample_indices]
 
@@ -147,6 +449,9 @@ def subsample_bin(X_bin, y_bin, num_samples):
 def bin_by_sliding_window(X: np.array, y: np.array, ages: np.array, window_size: int = 3):
     """Bins the data by a sliding age window.
 
+    This copies every window's samples, use get_sliding_windows() to get the
+    windows as indices instead.
+
     Parameters
     ----------
     X
@@ -176,7 +481,7 @@ def bin_by_sliding_window(X: np.array, y: np.array, ages: np.array, window_size:
     return all_sliding_windows, age_windows
 
 
-def bin_by_random_equivalent_size(X, y, bin_sizes=(114, 147, 112)) -> tuple:
+def bin_by_random_equivalent_size(X, y, bin_sizes=(114, 147, 112), random_state=None) -> tuple:
     """Bins the data into equivalent sized bins, disregarding age.
 
     Parameters
@@ -184,26 +489,28 @@ def bin_by_random_equivalent_size(X, y, bin_sizes=(114, 147, 112)) -> tuple:
     X
     y
     bin_sizes
+    random_state : int or np.random.Generator, optional
 
     Returns
     -------
 
     """
     X_bins, y_bins, bin_labels = [], [], []
-    random_indices = np.random.choice(X.shape[0], X.shape[0], replace=False)
-    bin_indices = [random_indices[0:bin_sizes[0]], random_indices[bin_sizes[0]:bin_sizes[0]+bin_sizes[1]], random_indices[bin_sizes[1]:bin_sizes[1]+bin_sizes[2]]]
+    bin_indices = get_equal_size_bin_indices(X.shape[0], bin_sizes,
+                                             random_state=random_state)
 
     for bin_num, bin_index in enumerate(bin_indices, start=1):
-        X_bins.append(X[bin_index])
-        y_bins.append(y[bin_index])
+        X_bins.append(X[bin_index[0]])
+        y_bins.append(y[bin_index[0]])
         bin_labels.append(f'Bin {bin_num}')
 
     return X_bins, y_bins, bin_labels
 
 
-def bin_to_approximate_size(X, y, N=75):
+def bin_to_approximate_size(X, y, N=75, random_state=None):
     if len(X) < N:
         return X, y
 
-    random_indices = np.random.choice(X.shape[0], N, replace=False)
+    random_indices = get_subsample_indices(X.shape[0], N,
+                                           random_state=random_state)[0]
     return X[random_indices], y[random_indices]
@@ -0,0 +1,234 @@
+"""
+Holds the functions for correcting permutation p-values for multiple comparisons.
+"""
+from os.path import exists, join
+
+import numpy as np
+import pandas as pd
+
+from common.binning import BIN_LABELS, EQUAL_BIN_LABELS
+from common.paths import PLS_PSCORES, RIDGE_PSCORES, CROSS_PRED_SCALED_PSCORES
+from common.results import load_perm_score
+from common.wisc import WISC_LEVEL
+
+
+def load_perm_scores_stack(model, population, targets=None, bin_labels=None,
+                           input_folder=None):
+    """
+    Loads the permutation scores of every target and bin for a specific model
+    and diagnosis into one array.
+
+    Targets and bins without saved permutation scores (E.g. bins for the
+    healthy population) are skipped.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    targets : list, optional
+        Defaults to the WISC primary indices and FSIQ.
+    bin_labels : list, optional
+        Defaults to all bins.
+    input_folder : str, optional
+        Defaults to the model's permutation score folder.
+
+    Returns
+    -------
+    perm_scores : np.array
+        Array (tests x permutations) of permutation scores.
+    index : pd.DataFrame
+        The target and bin of each test (row of perm_scores).
+
+    """
+    targets = WISC_LEVEL[5] if targets is None else targets
+    bin_labels = BIN_LABELS if bin_labels is None else bin_labels
+    if input_folder is None:
+        input_folder = PLS_PSCORES if model == 'pls' else RIDGE_PSCORES
+
+    perm_scores, index = [], []
+    for target in targets:
+        for bin_label in bin_labels:
+            fn = f'{model}_{population}_{target}_{bin_label}_perm_scores.npy'
+            if not exists(join(input_folder, fn)):
+                continue
+
+            perm_scores.append(load_perm_score(fn, input_folder))
+            index.append({'Target': target, 'Bin': bin_label})
+
+    return _stack_perm_scores(perm_scores), pd.DataFrame(index)
+
+
+def load_cross_prediction_perm_scores_stack(
+        model, population, targets=None, bin_labels=None,
+        input_folder=CROSS_PRED_SCALED_PSCORES):
+    """
+    Loads the cross-prediction permutation scores of every target and
+    train-test bin pair for a specific model and diagnosis into one array.
+
+    Each cross-prediction file holds the test bins in get_group_order()
+    order, so the test bins are the bin labels rotated to start at the
+    training bin. Every target and training bin must have a file, so the
+    correction family is never silently smaller than expected.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    targets : list, optional
+        Defaults to the WISC primary indices and FSIQ.
+    bin_labels : list, optional
+        The bins in the order used for cross-prediction, defaults to the
+        three age bins with the equal sample size Bin 2.
+    input_folder : str, optional
+        Defaults to the standard scaled cross-prediction permutation scores.
+
+    Returns
+    -------
+    perm_scores : np.array
+        Array (tests x permutations) of permutation scores.
+    index : pd.DataFrame
+        The target, training bin, and testing bin of each test.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the permutation scores of a target and training bin are missing.
+
+    """
+    targets = WISC_LEVEL[5] if targets is None else targets
+    bin_labels = EQUAL_BIN_LABELS if bin_labels is None else list(bin_labels)
+
+    perm_scores, index = [], []
+    for target in targets:
+        for train_idx, train_label in enumerate(bin_labels):
+            fn = f'{model}_{population}_{target}_{train_label}_cross_prediction_perm_scores.npy'
+            if not exists(join(input_folder, fn)):
+                raise FileNotFoundError(
+                    f'Missing cross-prediction permutation scores {fn} in '
+                    f'{input_folder}')
+
+            test_labels = bin_labels[train_idx:] + bin_labels[:train_idx]
+            for test_label, test_perm_scores in zip(
+                    test_labels, load_perm_score(fn, input_folder)):
+                perm_scores.append(test_perm_scores)
+                index.append(
+                    {'Target': target, 'Train': train_label, 'Test': test_label})
+
+    return _stack_perm_scores(perm_scores), pd.DataFrame(index)
+
+
+def correct_pvalues(scores, perm_scores, alpha=0.05, families=None):
+    """
+    Calculates the uncorrected, FDR corrected, and max-statistic corrected
+    permutation p-values of many tests at once.
+
+    The uncorrected p-value matches calc_pvalue(). The FDR p-value is the
+    Benjamini-Hochberg adjusted p-value. The max-statistic p-value compares
+    each score against the null distribution of the highest permutation
+    score across all tests in the family, controlling the family-wise error
+    rate.
+
+    Parameters
+    ----------
+    scores : np.array
+        The true score of each test.
+    perm_scores : np.array
+        Array (tests x permutations) of permutation scores, E.g. from
+        load_perm_scores_stack().
+    alpha : float, optional
+    families : np.array, optional
+        The family of each test (E.g. the bin) if corrections should be done
+        within families instead of across all tests.
+
+    Returns
+    -------
+    pd.DataFrame
+        The p-values of each test and whether they're significant.
+
+    Examples
+    --------
+    >>> perm_scores, index = load_perm_scores_stack('ridge', 'adhd')
+    >>> df, _ = load_results('ridge_pts_adhd', RIDGE_RESULTS)
+    >>> scores = index.merge(df, on=['Target', 'Bin'])['Score']
+    >>> index.join(correct_pvalues(scores, perm_scores, families=index['Bin']))
+
+    """
+    scores = np.asarray(scores, dtype=float)
+    perm_scores = np.asarray(perm_scores)
+    families = np.zeros(len(scores)) if families is None else np.asarray(families)
+    n_permutations = perm_scores.shape[1]
+
+    pvalues = (np.sum(perm_scores >= scores[:, np.newaxis], axis=1) + 1.0) / (
+        n_permutations + 1)
+    fdr_pvalues = np.zeros(len(scores))
+    max_stat_pvalues = np.zeros(len(scores))
+
+    for family in np.unique(families):
+        in_family = families == family
+        fdr_pvalues[in_family] = _calc_fdr_pvalues(pvalues[in_family])
+
+        # Count the permutations whose family-wide max reaches each score
+        max_null = np.sort(np.max(perm_scores[in_family], axis=0))
+        n_exceed = n_permutations - np.searchsorted(
+            max_null, scores[in_family], side='left')
+        max_stat_pvalues[in_family] = (n_exceed + 1.0) / (n_permutations + 1)
+
+    return pd.DataFrame({
+        'P-value': pvalues,
+        'FDR P-value': fdr_pvalues,
+        'Max-stat P-value': max_stat_pvalues,
+        'Uncorrected': pvalues < alpha,
+        'FDR': fdr_pvalues < alpha,
+        'Max-stat': max_stat_pvalues < alpha,
+    })
+
+
+def _calc_fdr_pvalues(pvalues):
+    """
+    Calculates the Benjamini-Hochberg adjusted p-values.
+
+    Helper function for correct_pvalues().
+
+    Parameters
+    ----------
+    pvalues : np.array
+
+    Returns
+    -------
+    np.array
+
+    """
+    n_tests = len(pvalues)
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * n_tests / np.arange(1, n_tests + 1)
+
+    # Enforce monotonicity from the largest p-value down
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+
+    fdr_pvalues = np.empty(n_tests)
+    fdr_pvalues[order] = np.minimum(ranked, 1)
+
+    return fdr_pvalues
+
+
+def _stack_perm_scores(perm_scores):
+    """
+    Stacks permutation score arrays into one (tests x permutations) array.
+
+    Parameters
+    ----------
+    perm_scores : list
+
+    Returns
+    -------
+    np.array
+
+    """
+    n_permutations = {len(test_perm_scores) for test_perm_scores in perm_scores}
+
+    if len(n_permutations) > 1:
+        raise ValueError(
+            f'Permutation scores have different numbers of permutations: '
+            f'{sorted(n_permutations)}')
+
+    return np.stack(perm_scores) if perm_scores else np.empty((0, 0))
@@ -1,12 +1,23 @@
 """
 Holds the functions for the cross-prediction (out-of-sample cross-validation) procedure.
 """
+import glob
+import hashlib
+import json
+import os
 from collections import deque
 
 import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
 from sklearn.base import clone
+from sklearn.linear_model import Ridge
+from sklearn.pipeline import Pipeline
 
-from common.scoring import calc_pvalue
+from common.paths import CROSS_PRED_PREDICTIONS
+from common.scoring import (
+    N_PERM, batch_scorer, calc_pvalue, get_n_chunks, get_permutation_seeds,
+    segment_scorer, sequential_permutation_test)
 
 
 def get_group_cv_splits(groups, cv):
@@ -103,13 +114,20 @@ def get_group_order(groups, cvs, labels):
 
 def cross_prediction_permutation_test_score(
         estimator, group_zero, group_one, group_two, cv_zero, cv_one, cv_two,
-        n_permutations=100, scorer=None):
+        n_permutations=100, scorer=None, n_jobs=None, random_state=None):
     """
     Custom permutation test function based on:
     https://scikit-learn.org/stable/modules/generated/sklearn.model_selection.permutation_test_score.html
 
     Extended to handle multiple testing sets used in cross-prediction.
 
+    Permutations are run in parallel and each permutation shuffles with its
+    own seeded generator, so the results only depend on random_state and not
+    on the number of workers.
+
+    Only trains on the first group. To train on every group (and any number
+    of groups) in one pass, use group_cross_prediction_permutation_test_score().
+
     Parameters
     ----------
     estimator : sklearn.model
@@ -121,6 +139,10 @@ def cross_prediction_permutation_test_score(
     cv_two : np.array
     n_permutations : int
     scorer : sklearn.estimator
+    n_jobs : int, optional
+        Number of processes to run the permutations on, -1 means all
+        processors.
+    random_state : int, optional
 
     Returns
     -------
@@ -129,98 +151,1393 @@ def cross_prediction_permutation_test_score(
         permutation scores, third element is a list of p-values.
 
     """
-    true_scores = _cross_prediction_permutation_test_score(
-        clone(estimator), group_zero[0], group_zero[1], group_one[0],
-        group_one[1], group_two[0], group_two[1], cv_zero, cv_one, cv_two,
-        scorer)
+    true_scores, permutation_scores, pvalues = _group_permutation_test_score(
+        estimator, [group_zero, group_one, group_two],
+        [cv_zero, cv_one, cv_two], [0], n_permutations, scorer, n_jobs,
+        random_state)
+
+    return true_scores[0], permutation_scores[0], list(pvalues[0])
+
+
+def group_cross_prediction_permutation_test_score(
+        estimator, groups, cvs, n_permutations=100, scorer=None, n_jobs=None,
+        random_state=None):
+    """
+    Cross-prediction permutation test for any number of groups, training on
+    every group.
+
+    Each training fold is fit once and scored on the matching test fold of
+    every group. Row i of the results is the same as training on group i with
+    the groups in the i-th order from get_group_order(), so the labels from
+    get_group_order() line up with the results.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+        List of tuples containing each group's samples and targets.
+    cvs : list
+        Each group's cross-validation splits, see get_group_cv_splits().
+    n_permutations : int
+    scorer : sklearn.scorer
+    n_jobs : int, optional
+        Number of processes to run the permutations on, -1 means all
+        processors.
+    random_state : int, optional
+
+    Returns
+    -------
+    tuple
+        The true scores (train group x test group), the permutation scores
+        (train group x test group x permutation), and the p-values (train
+        group x test group).
+
+    Raises
+    ------
+    ValueError
+        If n_permutations is less than 1.
+
+    Examples
+    --------
+    >>> bins_cv = get_group_cv_splits(bins, RKF_10_10)
+    >>> rs, perms, ps = group_cross_prediction_permutation_test_score(
+    ...     pipe, bins, bins_cv, N_PERM, unimetric_scorer)
+    >>> _, _, label_order = get_group_order(bins, bins_cv, bin_labels)
+    >>> rs[1], label_order[1]
+    (array([0.21, 0.05, 0.12]), deque(['Bin 2', 'Bin 3', 'Bin 1']))
+
+    """
+    return _group_permutation_test_score(
+        estimator, groups, cvs, range(len(groups)), n_permutations, scorer,
+        n_jobs, random_state)
+
+
+def _group_permutation_test_score(
+        estimator, groups, cvs, train_groups, n_permutations, scorer, n_jobs,
+        random_state):
+    """
+    Helper function for the cross-prediction permutation tests that scores the
+    true targets and every permutation for the given training groups.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    train_groups : list
+        Indices of the groups to train on.
+    n_permutations : int
+    scorer : sklearn.scorer
+    n_jobs : int
+    random_state : int
+
+    Returns
+    -------
+    tuple
+        The true scores, permutation scores, and p-values.
+
+    """
+    _check_n_permutations(n_permutations)
 
-    permutation_scores = []
-    for _ in range(n_permutations):
-        permutation_score = _cross_prediction_permutation_test_score(
-            clone(estimator), group_zero[0], _shuffle(group_zero[1]),
-            group_one[0], _shuffle(group_one[1]),
-            group_two[0], _shuffle(group_two[1]), cv_zero, cv_one, cv_two,
-            scorer)
-        permutation_scores.append(permutation_score)
+    true_scores = _group_cross_prediction_scores(
+        clone(estimator), [group[0] for group in groups],
+        [group[1] for group in groups], cvs, scorer, train_groups)
 
-    permutation_scores = np.array(permutation_scores).T
+    permutation_seeds = get_permutation_seeds(n_permutations, random_state)
+    permutation_scores = cross_prediction_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, scorer, n_jobs, train_groups)
 
-    pvalues = []
-    for true_score, perm_score in zip(true_scores, permutation_scores):
-        pvalue = calc_pvalue(perm_score, true_score, n_permutations)
-        pvalues.append(pvalue)
+    pvalues = _calc_group_pvalues(true_scores, permutation_scores)
 
     return true_scores, permutation_scores, pvalues
 
 
-def _cross_prediction_permutation_test_score(
-        estimator, X_0, y_0, X_1, y_1, X_2, y_2, cv_0, cv_1, cv_2, scorer):
+def cross_prediction_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, scorer=None, n_jobs=None,
+        train_groups=None):
+    """
+    Scores only the given permutations of a cross-prediction permutation test.
+
+    Used to run a permutation test in chunks (E.g. with
+    run_checkpointed_permutations()), since the seeds from
+    get_permutation_seeds() identify each permutation.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    permutation_seeds : list
+    scorer : sklearn.scorer
+    n_jobs : int, optional
+    train_groups : list, optional
+        Indices of the groups to train on, defaults to all groups.
+
+    Returns
+    -------
+    np.array
+        The permutation scores (train group x test group x permutation).
+
+    """
+    group_X = [group[0] for group in groups]
+    group_y = [group[1] for group in groups]
+    train_groups = range(len(groups)) if train_groups is None else train_groups
+
+    permutation_scores = Parallel(n_jobs=n_jobs)(
+        delayed(_permuted_group_cross_prediction_scores)(
+            clone(estimator), group_X, group_y, cvs, scorer, train_groups, seed)
+        for seed in permutation_seeds)
+
+    return np.moveaxis(np.array(permutation_scores), 0, -1)
+
+
+def _group_cross_prediction_scores(
+        estimator, group_X, group_y, cvs, scorer, train_groups):
     """
-    Helper function for cross_prediction_permutation_test_score() that splits
+    Helper function for the cross-prediction permutation tests that splits
     the dataset by the given cross-validation scheme and trains and tests the
     model.
 
-    Given three groups and their cross-fold validation splits, train on the
-    first group and test on all three groups. Return the average score from
-    all cross-folds.
+    For each training group, train on each of its cross folds and test on the
+    matching cross fold of every group. Return the average score from all
+    cross-folds.
 
     Parameters
     ----------
     estimator : sklearn.model
-    X_0 : np.array
-    y_0 : np.array
-    X_1 : np.array
-    y_1 : np.array
-    X_2 : np.array
-    y_2 : np.array
-    cv_0 : np.array
-    cv_1 : np.array
-    cv_2 : np.array
+    group_X : list
+        Each group's samples.
+    group_y : list
+        Each group's targets.
+    cvs : list
+        Each group's cross-validation splits.
     scorer : sklearn.scorer
+    train_groups : list
+        Indices of the groups to train on.
 
     Returns
     -------
-    int
-        The model's average score across all cross folds.
+    np.array
+        The model's average score across all cross folds (train group x test
+        group), with the test groups in get_group_order() order.
 
     """
-    group_scores = [[], [], []]
+    n_groups = len(group_X)
+    group_scores = np.zeros((len(train_groups), n_groups))
 
-    for curr_cv_0, curr_cv_1, curr_cv_2 in zip(cv_0, cv_1, cv_2):
-        # Train and test on the in-group data
-        cv_0_train, cv_0_test = curr_cv_0[0], curr_cv_0[1]
-        X_0_train, y_0_train = X_0[cv_0_train], y_0[cv_0_train]
-        X_0_test, y_0_test = X_0[cv_0_test], y_0[cv_0_test]
+    for row, train_group in enumerate(train_groups):
+        test_groups = _get_rotated_groups(train_group, n_groups)
+        fold_scores = []
 
-        estimator.fit(X_0_train, y_0_train)
-        group_scores[0].append(scorer(estimator, X_0_test, y_0_test))
+        for group_folds in zip(*cvs):
+            train = group_folds[train_group][0]
+            estimator.fit(group_X[train_group][train],
+                          group_y[train_group][train])
 
-        # Test on the out-group data
-        cv_1_test, cv_2_test = curr_cv_1[1], curr_cv_2[1]
-        X_1_test, y_1_test = X_1[cv_1_test], y_1[cv_1_test]
-        X_2_test, y_2_test = X_2[cv_2_test], y_2[cv_2_test]
+            # Test on the in-group data then the out-group data
+            fold_scores.append([
+                scorer(estimator, group_X[group][group_folds[group][1]],
+                       group_y[group][group_folds[group][1]])
+                for group in test_groups])
 
-        group_scores[1].append(scorer(estimator, X_1_test, y_1_test))
-        group_scores[2].append(scorer(estimator, X_2_test, y_2_test))
+        # Average the scores for each group independently
+        group_scores[row] = np.mean(fold_scores, axis=0)
 
-    # Average the scores for each group independently
-    return np.mean(group_scores, axis=1)
+    return group_scores
 
 
-def _shuffle(y):
+def _permuted_group_cross_prediction_scores(
+        estimator, group_X, group_y, cvs, scorer, train_groups, seed):
     """
-    Shuffles the given array.
+    Helper function for the cross-prediction permutation tests that shuffles
+    each group's targets and scores one permutation.
 
-    Helper function for cross_prediction_permutation_test_score().
+    Parameters
+    ----------
+    estimator : sklearn.model
+    group_X : list
+    group_y : list
+    cvs : list
+    scorer : sklearn.scorer
+    train_groups : list
+    seed : np.random.SeedSequence
+
+    Returns
+    -------
+    np.array
+        The model's average score (train group x test group).
+
+    """
+    rng = np.random.default_rng(seed)
+    group_y = [_shuffle(y, rng) for y in group_y]
+
+    return _group_cross_prediction_scores(
+        estimator, group_X, group_y, cvs, scorer, train_groups)
+
+
+def sequential_group_cross_prediction_test_score(
+        estimator, groups, cvs, max_permutations=N_PERM, scorer=None,
+        alpha=0.05, batch_size=50, closed_form_ridge=False, n_jobs=None,
+        random_state=None):
+    """
+    Sequential version of group_cross_prediction_permutation_test_score()
+    that stops adding permutations once every p-value is resolved relative to
+    alpha (see sequential_permutation_test()).
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    max_permutations : int, optional
+    scorer : sklearn.scorer
+        Ignored if closed_form_ridge is True.
+    alpha : float, optional
+    batch_size : int, optional
+    closed_form_ridge : bool, optional
+        Whether to use the closed-form ridge permutations scored by Pearson r
+        (see ridge_cross_prediction_permutation_test_score()).
+    n_jobs : int, optional
+    random_state : int, optional
+
+    Returns
+    -------
+    tuple
+        The true scores, the permutation scores that were run, the p-values,
+        and the number of permutations used for each p-value (all train group
+        x test group, with permutations on the last axis).
+
+    """
+    if closed_form_ridge:
+        true_scores = _ridge_permutation_scores(
+            estimator, groups, cvs, [], range(len(groups)), True)[..., 0]
+
+        def score_permutations(seeds):
+            return ridge_cross_prediction_permutation_scores(
+                estimator, groups, cvs, seeds)
+    else:
+        true_scores = _group_cross_prediction_scores(
+            clone(estimator), [group[0] for group in groups],
+            [group[1] for group in groups], cvs, scorer, range(len(groups)))
+
+        def score_permutations(seeds):
+            return cross_prediction_permutation_scores(
+                estimator, groups, cvs, seeds, scorer, n_jobs)
+
+    permutation_scores, pvalues, n_permutations = sequential_permutation_test(
+        score_permutations, true_scores, max_permutations, alpha, batch_size,
+        random_state=random_state)
+
+    return true_scores, permutation_scores, pvalues, n_permutations
+
+
+def sequential_permutation_test_score(
+        estimator, X, y, cv, scorer=None, max_permutations=N_PERM, alpha=0.05,
+        batch_size=50, closed_form_ridge=False, n_jobs=None,
+        random_state=None):
+    """
+    Sequential version of sklearn's permutation_test_score() for a single
+    group, stopping once the p-value is resolved relative to alpha.
+
+    A single-group permutation test is cross-prediction with one group, so
+    this uses sequential_group_cross_prediction_test_score().
 
     Parameters
     ----------
+    estimator : sklearn.model
+    X : np.array
     y : np.array
+    cv : sklearn.cross_validation instance
+    scorer : sklearn.scorer
+    max_permutations : int, optional
+    alpha : float, optional
+    batch_size : int, optional
+    closed_form_ridge : bool, optional
+    n_jobs : int, optional
+    random_state : int, optional
+
+    Returns
+    -------
+    tuple
+        The true score, the permutation scores that were run, the p-value, and
+        the number of permutations used.
+
+    Examples
+    --------
+    >>> score, perms, pvalue, n_perm = sequential_permutation_test_score(
+    ...     pipe, X_cv, y_cv, RKF_10_10, unimetric_scorer)
+    >>> CVResult('ridge', target, bin_label, bin_label, score, pvalue,
+    ...          population, n_perm)
+
+    """
+    true_scores, permutation_scores, pvalues, n_permutations = (
+        sequential_group_cross_prediction_test_score(
+            estimator, [(X, y)], get_group_cv_splits([(X, y)], cv),
+            max_permutations, scorer, alpha, batch_size, closed_form_ridge,
+            n_jobs, random_state))
+
+    return (true_scores[0, 0], permutation_scores[0, 0], pvalues[0, 0],
+            n_permutations[0, 0])
+
+
+class CrossPredictions:
+    """
+    Class containing the out-of-fold predictions of a cross-prediction run,
+    so they can be scored with any metric or resampled without refitting.
+
+    For each test group, the test folds are concatenated in cross-validation
+    order, and every training group's predictions line up with them.
+
+    Attributes
+    ----------
+    train_groups : tuple
+        Indices of the groups trained on.
+    test_indices : list
+        Each group's concatenated test fold indices.
+    fold_starts : list
+        Where each test fold starts in each group's concatenated test folds.
+    y_true : list
+        Each group's (possibly permuted) targets for its concatenated test
+        folds.
+    predictions : list
+        Each group's predictions (training group x concatenated test folds).
+    """
+    def __init__(self, train_groups, test_indices, fold_starts, y_true,
+                 predictions):
+        """
+        Initializes the predictions of each test group.
+
+        Parameters
+        ----------
+        train_groups : list
+        test_indices : list
+        fold_starts : list
+        y_true : list
+        predictions : list
+
+        """
+        self.train_groups = tuple(train_groups)
+        self.test_indices = test_indices
+        self.fold_starts = fold_starts
+        self.y_true = y_true
+        self.predictions = predictions
+
+    def score(self, metric='r'):
+        """
+        Scores the predictions, averaging the scores of the cross folds like
+        the cross-prediction permutation tests.
+
+        Parameters
+        ----------
+        metric : str, optional
+            Any metric of segment_scorer() ('r', 'mse', or 'r2').
+
+        Returns
+        -------
+        np.array
+            The average score (train group x test group), with the test groups
+            in get_group_order() order.
+
+        """
+        group_scores = []
+
+        for y_true, predictions, fold_starts in zip(
+                self.y_true, self.predictions, self.fold_starts):
+            scores = segment_scorer(y_true, predictions, fold_starts,
+                                    metrics=(metric,))[metric]
+            group_scores.append(scores.mean(axis=-1))
+
+        return self._rotate(np.stack(group_scores, axis=-1))
+
+    def bootstrap_scores(self, seeds, metric='r'):
+        """
+        Scores bootstrap samples of the predictions, resampling the subjects
+        within each group with replacement.
+
+        Each subject's predictions are reused, weighted by how many times the
+        subject was drawn, so the estimator isn't refit.
+
+        Parameters
+        ----------
+        seeds : list
+            One np.random.SeedSequence per bootstrap sample, see
+            get_permutation_seeds().
+        metric : str, optional
+
+        Returns
+        -------
+        np.array
+            The average score of each bootstrap sample (train group x test
+            group x bootstrap sample).
+
+        """
+        rngs = [np.random.default_rng(seed) for seed in seeds]
+        group_scores = []
+
+        for y_true, predictions, fold_starts, test_indices in zip(
+                self.y_true, self.predictions, self.fold_starts,
+                self.test_indices):
+            n_subjects = test_indices.max() + 1
+            counts = np.array([
+                np.bincount(rng.integers(n_subjects, size=n_subjects),
+                            minlength=n_subjects)
+                for rng in rngs])
+            weights = counts[:, np.newaxis, test_indices]
+
+            scores = segment_scorer(y_true, predictions, fold_starts, weights,
+                                    metrics=(metric,))[metric]
+            group_scores.append(np.nanmean(scores, axis=-1).T)
+
+        return self._rotate(np.stack(group_scores, axis=1))
+
+    def save(self, filepath, metadata=None):
+        """
+        Saves the predictions to a NumPy archive (.npz).
+
+        Parameters
+        ----------
+        filepath : str
+        metadata : dict, optional
+            JSON-serializable information about the predictions (E.g. the
+            target), returned by load_cross_predictions().
+
+        Returns
+        -------
+        str
+            Location of the saved predictions.
+
+        """
+        arrays = {'train_groups': np.array(self.train_groups)}
+        for group in range(len(self.predictions)):
+            arrays[f'test_indices_{group}'] = self.test_indices[group]
+            arrays[f'fold_starts_{group}'] = self.fold_starts[group]
+            arrays[f'y_true_{group}'] = self.y_true[group]
+            arrays[f'predictions_{group}'] = self.predictions[group]
+
+        # Write under a temporary name so a killed run never leaves a partial
+        # file that looks cached
+        tmp_path = f'{filepath}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, metadata=json.dumps(metadata or {}), **arrays)
+        os.replace(tmp_path, filepath)
+
+        return filepath
+
+    def _rotate(self, scores):
+        """
+        Reorders the test groups of each training group to start at the
+        training group, matching get_group_order().
+
+        Parameters
+        ----------
+        scores : np.array
+            Scores (train group x test group x ...) in group order.
+
+        Returns
+        -------
+        np.array
+
+        """
+        n_groups = len(self.predictions)
+
+        return np.stack([
+            scores[row, _get_rotated_groups(train_group, n_groups)]
+            for row, train_group in enumerate(self.train_groups)])
+
+
+def get_cross_predictions(estimator, groups, cvs, train_groups=None,
+                          permutation_seed=None, n_jobs=None):
+    """
+    Runs cross-prediction and keeps the out-of-fold predictions instead of
+    the scores.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+        List of tuples containing each group's samples and targets.
+    cvs : list
+        Each group's cross-validation splits, see get_group_cv_splits().
+    train_groups : list, optional
+        Indices of the groups to train on, defaults to all groups.
+    permutation_seed : np.random.SeedSequence, optional
+        Seed from get_permutation_seeds() to shuffle the targets with, the
+        same way the permutation tests shuffle them.
+    n_jobs : int, optional
+        Number of processes to fit the cross folds on.
+
+    Returns
+    -------
+    CrossPredictions
+
+    Examples
+    --------
+    >>> predictions = get_cross_predictions(pipe, bins, bins_cv, n_jobs=-1)
+    >>> predictions.score('r'), predictions.score('r2')
+
+    """
+    group_X = [group[0] for group in groups]
+    group_y = [group[1] for group in groups]
+    train_groups = range(len(groups)) if train_groups is None else train_groups
+
+    if permutation_seed is not None:
+        rng = np.random.default_rng(permutation_seed)
+        group_y = [_shuffle(y, rng) for y in group_y]
+
+    fold_predictions = Parallel(n_jobs=n_jobs)(
+        delayed(_fold_cross_predictions)(
+            clone(estimator), group_X, group_y, group_folds, train_groups)
+        for group_folds in zip(*cvs))
+
+    test_indices, fold_starts, y_true, predictions = [], [], [], []
+    for group, cv in enumerate(cvs):
+        group_test_indices = [test for _, test in cv]
+        test_indices.append(np.concatenate(group_test_indices))
+        fold_starts.append(np.cumsum(
+            [0] + [len(test) for test in group_test_indices[:-1]]))
+        y_true.append(np.asarray(group_y[group])[test_indices[-1]])
+        predictions.append(np.array([
+            np.concatenate([fold[row][group] for fold in fold_predictions])
+            for row in range(len(train_groups))]))
+
+    return CrossPredictions(train_groups, test_indices, fold_starts, y_true,
+                            predictions)
+
+
+def load_cross_predictions(filepath):
+    """
+    Loads predictions saved with CrossPredictions.save().
+
+    Parameters
+    ----------
+    filepath : str
+
+    Returns
+    -------
+    tuple
+        The CrossPredictions and their metadata.
+
+    """
+    with np.load(filepath) as archive:
+        n_groups = sum(name.startswith('predictions_')
+                       for name in archive.files)
+        predictions = CrossPredictions(
+            archive['train_groups'].tolist(),
+            *([archive[f'{name}_{group}'] for group in range(n_groups)]
+              for name in ('test_indices', 'fold_starts', 'y_true',
+                           'predictions')))
+
+        return predictions, json.loads(str(archive['metadata']))
+
+
+def get_cross_predictions_data_key(estimator, groups, cvs):
+    """
+    Gets the part of the cross-prediction cache key that's shared by every
+    permutation of a run.
+
+    The key is the SHA-256 hash of the estimator's parameters, the groups'
+    data, and the cross-validation fold indices. Hashing the data is the slow
+    part of the cache key, so compute this once per run and pass it to
+    get_cross_predictions_cache_key().
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+
+    Returns
+    -------
+    str
+
+    """
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps(_get_estimator_params(estimator),
+                               sort_keys=True).encode())
+
+    for X, y in groups:
+        for array in (X, y):
+            array = np.ascontiguousarray(array)
+            key_hash.update(f'{array.dtype}{array.shape}'.encode())
+            key_hash.update(memoryview(array).cast('B'))
+
+    for cv in cvs:
+        for train, test in cv:
+            key_hash.update(np.asarray(train, dtype=np.int64).tobytes())
+            key_hash.update(b'|')
+            key_hash.update(np.asarray(test, dtype=np.int64).tobytes())
+
+    return key_hash.hexdigest()
+
+
+def get_cross_predictions_cache_key(estimator, groups, cvs, target=None,
+                                    train_groups=None, permutation_seed=None,
+                                    labels=None, population=None,
+                                    data_key=None):
+    """
+    Gets the content-addressed cache key for a cross-prediction run's
+    out-of-fold predictions.
+
+    The key is the SHA-256 hash of the estimator's parameters, the groups'
+    data, the cross-validation fold indices, the target, the training groups,
+    the permutation seed, and the labels, so it changes if any of them
+    change.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    target : str, optional
+    train_groups : list, optional
+    permutation_seed : np.random.SeedSequence, optional
+    labels : list, optional
+    population : str, optional
+    data_key : str, optional
+        Key from get_cross_predictions_data_key() for the same estimator,
+        groups, and folds, to avoid hashing the data again.
+
+    Returns
+    -------
+    str
+
+    """
+    if data_key is None:
+        data_key = get_cross_predictions_data_key(estimator, groups, cvs)
+
+    key_hash = hashlib.sha256(data_key.encode())
+    key_hash.update(json.dumps({
+        'target': target,
+        'train_groups': None if train_groups is None else list(train_groups),
+        'permutation_seed': _get_seed_metadata(permutation_seed),
+        'labels': None if labels is None else list(labels),
+        'population': population,
+    }, sort_keys=True).encode())
+
+    return key_hash.hexdigest()
+
+
+def get_cached_cross_predictions(
+        estimator, groups, cvs, target=None, train_groups=None,
+        permutation_seed=None, cache_folder=CROSS_PRED_PREDICTIONS,
+        n_jobs=None, labels=None, population=None, data_key=None):
+    """
+    Gets the out-of-fold predictions of a cross-prediction run, loading them
+    from the cache if the same run was done before and running and caching
+    them otherwise.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    target : str, optional
+        The WISC measure, stored with the predictions for rescoring.
+    train_groups : list, optional
+    permutation_seed : np.random.SeedSequence, optional
+    cache_folder : str, optional
+    n_jobs : int, optional
+    labels : list, optional
+        Each group's label (E.g. the bin labels), stored with the predictions
+        for rescoring.
+    population : str, optional
+        Stored with the predictions for rescoring.
+    data_key : str, optional
+        See get_cross_predictions_cache_key().
+
+    Returns
+    -------
+    CrossPredictions
+
+    Examples
+    --------
+    >>> predictions = get_cached_cross_predictions(
+    ...     pipe, bins, bins_cv, target, labels=bin_labels, population='adhd')
+    >>> predictions.score('r2')
+
+    """
+    cache_key = get_cross_predictions_cache_key(
+        estimator, groups, cvs, target, train_groups, permutation_seed,
+        labels, population, data_key)
+    cache_path = os.path.join(cache_folder, f'{cache_key}.npz')
+
+    if os.path.exists(cache_path):
+        return load_cross_predictions(cache_path)[0]
+
+    predictions = get_cross_predictions(estimator, groups, cvs, train_groups,
+                                        permutation_seed, n_jobs)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    predictions.save(cache_path, {
+        'estimator': _get_estimator_name(estimator),
+        'estimator_params': _get_estimator_params(estimator),
+        'population': population,
+        'target': target,
+        'labels': None if labels is None else list(labels),
+        'permutation_seed': _get_seed_metadata(permutation_seed),
+    })
+
+    return predictions
+
+
+def cached_cross_prediction_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, metric='r', target=None,
+        cache_folder=CROSS_PRED_PREDICTIONS, n_jobs=None, train_groups=None,
+        labels=None, population=None):
+    """
+    Same as cross_prediction_permutation_scores(), but caches the out-of-fold
+    predictions of every permutation so they can be rescored with another
+    metric without refitting (see rescore_cached_cross_predictions()).
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    permutation_seeds : list
+    metric : str, optional
+        Any metric of segment_scorer() ('r', 'mse', or 'r2').
+    target : str, optional
+    cache_folder : str, optional
+    n_jobs : int, optional
+    train_groups : list, optional
+    labels : list, optional
+    population : str, optional
 
     Returns
     -------
     np.array
-        The given array randomly shuffled.
+        The permutation scores (train group x test group x permutation).
 
     """
-    return np.random.default_rng().permutation(y)
+    # Hash the data once, each permutation only adds its seed to the key
+    data_key = get_cross_predictions_data_key(estimator, groups, cvs)
+
+    permutation_scores = Parallel(n_jobs=n_jobs)(
+        delayed(_cached_permutation_scores)(
+            estimator, groups, cvs, seed, metric, target, cache_folder,
+            train_groups, labels, population, data_key)
+        for seed in permutation_seeds)
+
+    return np.moveaxis(np.array(permutation_scores), 0, -1)
+
+
+def rescore_cached_cross_predictions(metric='r', target=None,
+                                     cache_folder=CROSS_PRED_PREDICTIONS):
+    """
+    Scores every cached cross-prediction run with the given metric, without
+    refitting.
+
+    Parameters
+    ----------
+    metric : str, optional
+        Any metric of segment_scorer() ('r', 'mse', or 'r2').
+    target : str, optional
+        Only rescore the runs of this WISC measure.
+    cache_folder : str, optional
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per run, training group, and test group, with the estimator,
+        population, target, and permutation (index from
+        get_permutation_seeds(), None for the true targets) of the run. Test
+        groups are numbered in get_group_order() order, and the 'Train' and
+        'Test' columns have the group labels if they were cached.
+
+    Examples
+    --------
+    >>> r2 = rescore_cached_cross_predictions('r2', 'WISC_FSIQ')
+    >>> r2[r2['Permutation'].isna()]
+
+    """
+    rows = []
+
+    for cache_path in sorted(glob.glob(os.path.join(cache_folder, '*.npz'))):
+        predictions, metadata = load_cross_predictions(cache_path)
+        if target is not None and metadata.get('target') != target:
+            continue
+
+        seed = metadata.get('permutation_seed')
+        permutation = None if seed is None else seed['spawn_key'][-1]
+        labels = metadata.get('labels')
+        n_groups = len(predictions.predictions)
+        scores = predictions.score(metric)
+
+        for row, train_group in enumerate(predictions.train_groups):
+            test_groups = _get_rotated_groups(train_group, n_groups)
+
+            for test_order, score in enumerate(scores[row]):
+                rows.append({
+                    'Model': metadata.get('estimator'),
+                    'Estimator Params': json.dumps(
+                        metadata.get('estimator_params'), sort_keys=True),
+                    'Population': metadata.get('population'),
+                    'Target': metadata.get('target'),
+                    'Permutation': permutation,
+                    'Train': None if labels is None else labels[train_group],
+                    'Test': (None if labels is None
+                             else labels[test_groups[test_order]]),
+                    'Train Group': train_group,
+                    'Test Order': test_order,
+                    'Metric': metric,
+                    'Score': score,
+                    'Key': os.path.splitext(os.path.basename(cache_path))[0],
+                })
+
+    return pd.DataFrame(rows)
+
+
+def _cached_permutation_scores(estimator, groups, cvs, seed, metric, target,
+                               cache_folder, train_groups, labels, population,
+                               data_key):
+    """
+    Scores one permutation from its cached out-of-fold predictions.
+
+    Helper function for cached_cross_prediction_permutation_scores().
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    seed : np.random.SeedSequence
+    metric : str
+    target : str or None
+    cache_folder : str
+    train_groups : list or None
+    labels : list or None
+    population : str or None
+    data_key : str
+
+    Returns
+    -------
+    np.array
+        The model's average score (train group x test group).
+
+    """
+    return get_cached_cross_predictions(
+        estimator, groups, cvs, target, train_groups, seed, cache_folder,
+        labels=labels, population=population, data_key=data_key).score(metric)
+
+
+def _get_estimator_name(estimator):
+    """
+    Gets a readable name of an estimator, listing the steps of a pipeline.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+
+    Returns
+    -------
+    str
+
+    """
+    if hasattr(estimator, 'steps'):
+        return ' -> '.join(type(step).__name__ for _, step in estimator.steps)
+
+    return type(estimator).__name__
+
+
+def _get_estimator_params(estimator):
+    """
+    Gets the estimator's parameters in a JSON-serializable form, with
+    non-JSON values (E.g. pipeline steps) replaced by their repr().
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+
+    Returns
+    -------
+    dict
+
+    """
+    return json.loads(json.dumps(estimator.get_params(deep=True), default=repr))
+
+
+def _get_seed_metadata(seed):
+    """
+    Gets a JSON-serializable description of a permutation seed.
+
+    Parameters
+    ----------
+    seed : np.random.SeedSequence or None
+
+    Returns
+    -------
+    dict or None
+
+    """
+    if seed is None:
+        return None
+
+    return {'entropy': str(seed.entropy), 'spawn_key': list(seed.spawn_key)}
+
+
+def bootstrap_cross_prediction_scores(
+        estimator, groups, cvs, n_boot=1000, metric='r', alpha=0.05,
+        train_groups=None, n_jobs=None, random_state=None, predictions=None):
+    """
+    Bootstrap confidence intervals of the cross-prediction scores.
+
+    The cross folds are fit once, then each bootstrap sample resamples the
+    subjects within each group and rescores the out-of-fold predictions, so
+    the bootstrap doesn't refit the estimator.
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    groups : list
+    cvs : list
+    n_boot : int, optional
+    metric : str, optional
+        Any metric of segment_scorer() ('r', 'mse', or 'r2').
+    alpha : float, optional
+        Significance level of the percentile confidence intervals.
+    train_groups : list, optional
+        Indices of the groups to train on, defaults to all groups.
+    n_jobs : int, optional
+        Number of processes to fit the cross folds and score the bootstrap
+        samples on.
+    random_state : int, optional
+        Each bootstrap sample gets its own seed, so the result doesn't depend
+        on n_jobs.
+    predictions : CrossPredictions, optional
+        Predictions from get_cross_predictions() to reuse instead of fitting.
+
+    Returns
+    -------
+    tuple
+        The scores (train group x test group), the confidence intervals
+        (train group x test group x 2), and the bootstrap scores (train group
+        x test group x bootstrap sample).
+
+    Examples
+    --------
+    >>> scores, cis, _ = bootstrap_cross_prediction_scores(
+    ...     pipe, bins, bins_cv, 1000, n_jobs=-1, random_state=0)
+    >>> _, _, label_order = get_group_order(bins, bins_cv, bin_labels)
+
+    """
+    if predictions is None:
+        predictions = get_cross_predictions(estimator, groups, cvs,
+                                            train_groups, n_jobs=n_jobs)
+
+    seeds = get_permutation_seeds(n_boot, random_state)
+    seed_chunks = np.array_split(np.array(seeds, dtype=object),
+                                 get_n_chunks(n_boot, n_jobs))
+    bootstrap_scores = Parallel(n_jobs=n_jobs)(
+        delayed(predictions.bootstrap_scores)(list(seed_chunk), metric)
+        for seed_chunk in seed_chunks)
+    bootstrap_scores = np.concatenate(bootstrap_scores, axis=-1)
+
+    cis = np.moveaxis(np.nanquantile(
+        bootstrap_scores, [alpha / 2, 1 - alpha / 2], axis=-1), 0, -1)
+
+    return predictions.score(metric), cis, bootstrap_scores
+
+
+def _fold_cross_predictions(estimator, group_X, group_y, group_folds,
+                            train_groups):
+    """
+    Fits each training group on one cross fold and predicts the matching
+    test fold of every group.
+
+    Helper function for get_cross_predictions().
+
+    Parameters
+    ----------
+    estimator : sklearn.model
+    group_X : list
+    group_y : list
+    group_folds : tuple
+        Each group's (train, test) split for this cross fold.
+    train_groups : list
+
+    Returns
+    -------
+    list
+        The predictions (train group x group) of this cross fold.
+
+    """
+    fold_predictions = []
+
+    for train_group in train_groups:
+        train = group_folds[train_group][0]
+        estimator.fit(group_X[train_group][train],
+                      group_y[train_group][train])
+
+        fold_predictions.append([
+            np.ravel(estimator.predict(X[test]))
+            for X, (_, test) in zip(group_X, group_folds)])
+
+    return fold_predictions
+
+
+def ridge_cross_prediction_permutation_test_score(
+        estimator, group_zero, group_one, group_two, cv_zero, cv_one, cv_two,
+        n_permutations=100, random_state=None):
+    """
+    Closed-form version of cross_prediction_permutation_test_score() for
+    ridge regression scored by Pearson r (I.e. unimetric_scorer).
+
+    Shuffling y doesn't change the training data X, so instead of refitting
+    for every permutation, each fold's training data is factorized once and
+    the true and all permuted targets are solved for together. Because there
+    are far fewer subjects than connections, the ridge solution is computed
+    in its dual form from the eigendecomposition of the (subjects x subjects)
+    kernel of the training data.
+
+    The permutations use the same seeds as
+    cross_prediction_permutation_test_score(), so both functions give the same
+    results up to numerical precision.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+        A ridge model with a single alpha, or a pipeline ending in one. Any
+        steps before the ridge model (E.g. StandardScaler) are fit once per
+        fold and must not depend on y.
+    group_zero : np.array
+    group_one : np.array
+    group_two : np.array
+    cv_zero : np.array
+    cv_one : np.array
+    cv_two : np.array
+    n_permutations : int
+    random_state : int, optional
+
+    Returns
+    -------
+    tuple
+        First element is a list of true scores, second element is a list of
+        permutation scores, third element is a list of p-values.
+
+    """
+    true_scores, permutation_scores, pvalues = (
+        _ridge_group_permutation_test_score(
+            estimator, [group_zero, group_one, group_two],
+            [cv_zero, cv_one, cv_two], [0], n_permutations, random_state))
+
+    return true_scores[0], permutation_scores[0], list(pvalues[0])
+
+
+def ridge_group_cross_prediction_permutation_test_score(
+        estimator, groups, cvs, n_permutations=100, random_state=None):
+    """
+    Closed-form version of group_cross_prediction_permutation_test_score()
+    for ridge regression scored by Pearson r (I.e. unimetric_scorer).
+
+    See ridge_cross_prediction_permutation_test_score() for how the
+    permutations are solved together.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+    groups : list
+    cvs : list
+    n_permutations : int
+    random_state : int, optional
+
+    Returns
+    -------
+    tuple
+        The true scores (train group x test group), the permutation scores
+        (train group x test group x permutation), and the p-values (train
+        group x test group).
+
+    """
+    return _ridge_group_permutation_test_score(
+        estimator, groups, cvs, range(len(groups)), n_permutations,
+        random_state)
+
+
+def _ridge_group_permutation_test_score(
+        estimator, groups, cvs, train_groups, n_permutations, random_state):
+    """
+    Helper function for the closed-form ridge permutation tests that scores
+    the true targets and every permutation.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+    groups : list
+    cvs : list
+    train_groups : list
+    n_permutations : int
+    random_state : int
+
+    Returns
+    -------
+    tuple
+        The true scores, permutation scores, and p-values.
+
+    """
+    _check_n_permutations(n_permutations)
+
+    permutation_seeds = get_permutation_seeds(n_permutations, random_state)
+    scores = _ridge_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, train_groups, True)
+
+    true_scores, permutation_scores = scores[..., 0], scores[..., 1:]
+    pvalues = _calc_group_pvalues(true_scores, permutation_scores)
+
+    return true_scores, permutation_scores, pvalues
+
+
+def ridge_cross_prediction_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, train_groups=None):
+    """
+    Closed-form version of cross_prediction_permutation_scores() for ridge
+    regression scored by Pearson r.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+    groups : list
+    cvs : list
+    permutation_seeds : list
+    train_groups : list, optional
+        Indices of the groups to train on, defaults to all groups.
+
+    Returns
+    -------
+    np.array
+        The permutation scores (train group x test group x permutation).
+
+    """
+    train_groups = range(len(groups)) if train_groups is None else train_groups
+
+    return _ridge_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, train_groups, False)
+
+
+def _ridge_permutation_scores(
+        estimator, groups, cvs, permutation_seeds, train_groups,
+        include_true):
+    """
+    Helper function for the closed-form ridge permutation tests that builds
+    the permuted targets and scores them all at once.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+    groups : list
+    cvs : list
+    permutation_seeds : list
+    train_groups : list
+    include_true : bool
+        Whether to also score the true targets as the first column.
+
+    Returns
+    -------
+    np.array
+        The scores (train group x test group x targets).
+
+    """
+    # Each group's targets as columns: (the true targets then) every permutation
+    n_true = 1 if include_true else 0
+    group_targets = [np.empty((len(group[1]), len(permutation_seeds) + n_true))
+                     for group in groups]
+    if include_true:
+        for group, targets in zip(groups, group_targets):
+            targets[:, 0] = group[1]
+
+    for perm, seed in enumerate(permutation_seeds, start=n_true):
+        rng = np.random.default_rng(seed)
+        for group, targets in zip(groups, group_targets):
+            targets[:, perm] = _shuffle(group[1], rng)
+
+    return _ridge_group_cross_prediction_scores(
+        estimator, [group[0] for group in groups], group_targets, cvs,
+        train_groups)
+
+
+def _ridge_group_cross_prediction_scores(
+        estimator, group_X, group_targets, cvs, train_groups):
+    """
+    Helper function for the closed-form ridge permutation tests that trains
+    on each training group and tests on all groups for many targets at once.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+    group_X : list
+        Each group's samples.
+    group_targets : list
+        Each group's targets (samples x targets).
+    cvs : list
+        Each group's cross-validation splits.
+    train_groups : list
+        Indices of the groups to train on.
+
+    Returns
+    -------
+    np.array
+        The average Pearson r across all cross folds (train group x test group
+        x targets), with the test groups in get_group_order() order.
+
+    """
+    preprocessing, ridge = _split_ridge_estimator(estimator)
+    n_groups, n_targets = len(group_X), group_targets[0].shape[1]
+    group_scores = np.zeros((len(train_groups), n_groups, n_targets))
+
+    for row, train_group in enumerate(train_groups):
+        test_groups = _get_rotated_groups(train_group, n_groups)
+        n_folds = 0
+
+        for group_folds in zip(*cvs):
+            train = group_folds[train_group][0]
+            X_train = group_X[train_group][train]
+            y_train = group_targets[train_group][train]
+
+            if preprocessing is not None:
+                preprocessing = clone(preprocessing).fit(X_train)
+                X_train = preprocessing.transform(X_train)
+
+            if ridge.fit_intercept:
+                X_offset, y_offset = X_train.mean(axis=0), y_train.mean(axis=0)
+            else:
+                X_offset, y_offset = 0, 0
+            X_train = X_train - X_offset
+
+            # Dual ridge solution for all targets: (K + alpha * I)^-1 y
+            eigvals, eigvecs = np.linalg.eigh(X_train @ X_train.T)
+            dual_coef = eigvecs @ (
+                (eigvecs.T @ (y_train - y_offset)) /
+                (eigvals + ridge.alpha)[:, np.newaxis])
+
+            for col, group in enumerate(test_groups):
+                test = group_folds[group][1]
+                X_test = group_X[group][test]
+                if preprocessing is not None:
+                    X_test = preprocessing.transform(X_test)
+
+                y_pred = (((X_test - X_offset) @ X_train.T) @ dual_coef
+                          + y_offset)
+                group_scores[row, col] += batch_scorer(
+                    group_targets[group][test], y_pred, metrics=('r',))['r']
+
+            n_folds += 1
+
+        # Average the scores for each group independently
+        group_scores[row] /= n_folds
+
+    return group_scores
+
+
+def _split_ridge_estimator(estimator):
+    """
+    Splits a ridge model or a pipeline ending in one into the preprocessing
+    steps and the ridge model.
+
+    Parameters
+    ----------
+    estimator : sklearn.linear_model.Ridge or sklearn.pipeline.Pipeline
+
+    Returns
+    -------
+    tuple
+        The preprocessing pipeline (None if there isn't one) and the ridge
+        model.
+
+    """
+    preprocessing = None
+
+    if isinstance(estimator, Pipeline):
+        if len(estimator.steps) > 1:
+            preprocessing = Pipeline(estimator.steps[:-1])
+        estimator = estimator.steps[-1][1]
+
+    if not isinstance(estimator, Ridge) or np.ndim(estimator.alpha) != 0:
+        raise ValueError('Estimator must be a Ridge model with a single alpha '
+                         'or a pipeline ending in one')
+
+    return preprocessing, estimator
+
+
+def _get_rotated_groups(first_group, n_groups):
+    """
+    Gets the group indices rotated to start at the given group, matching the
+    order from get_group_order().
+
+    Parameters
+    ----------
+    first_group : int
+    n_groups : int
+
+    Returns
+    -------
+    list
+
+    """
+    return [(first_group + offset) % n_groups for offset in range(n_groups)]
+
+
+def _check_n_permutations(n_permutations):
+    """
+    Checks that a permutation test has at least one permutation, since the
+    p-values are undefined without any.
+
+    Parameters
+    ----------
+    n_permutations : int
+
+    Returns
+    -------
+    None
+
+    """
+    if n_permutations < 1:
+        raise ValueError(f'n_permutations must be at least 1, got '
+                         f'{n_permutations}')
+
+
+def _calc_group_pvalues(true_scores, permutation_scores):
+    """
+    Calculates the permutation p-value of every cross-prediction score.
+
+    Parameters
+    ----------
+    true_scores : np.array
+        The true scores (train group x test group).
+    permutation_scores : np.array
+        The permutation scores (train group x test group x permutation).
+
+    Returns
+    -------
+    np.array
+
+    """
+    n_permutations = permutation_scores.shape[-1]
+    pvalues = np.zeros(true_scores.shape)
+
+    for cell in np.ndindex(true_scores.shape):
+        pvalues[cell] = calc_pvalue(
+            permutation_scores[cell], true_scores[cell], n_permutations)
+
+    return pvalues
+
+
+def _shuffle(y, rng=None):
+    """
+    Shuffles the given array.
+
+    Helper function for cross_prediction_permutation_test_score().
+
+    Parameters
+    ----------
+    y : np.array
+    rng : np.random.Generator, optional
+
+    Returns
+    -------
+    np.array
+        The given array randomly shuffled.
+
+    """
+    rng = np.random.default_rng() if rng is None else rng
+
+    return rng.permutation(y)
@@ -7,12 +7,18 @@ import os
 import numpy as np
 import pandas as pd
 
-from common.paths import POWER_FC, ADHD
-from common.power_atlas import to_power_fc_vector, get_power_fc_vector_labels
+from common.paths import POWER_FC, POWER_FC_STORE, ADHD
+from common.power_atlas import (
+    POWER_NUM_CONNECTIONS, to_power_fc_vector, get_network_connection_indices,
+    get_network_connection_mask)
 from common.wisc import WISC_LEVEL
 
+FC_STORE_MATRIX = 'power_fc_vectors.npy'
+FC_STORE_MANIFEST = 'power_fc_subjects.csv'
 
-def get_data(wisc_level=5, label_path=ADHD):
+
+def get_data(wisc_level=5, label_path=ADHD, use_store=False,
+             store_folder=POWER_FC_STORE, dtype=np.float64):
     """
     Gets functional connectivity data, cognition data, and demographic data.
 
@@ -25,6 +31,15 @@ def get_data(wisc_level=5, label_path=ADHD):
     ----------
     wisc_level : int
     label_path : str
+    use_store : bool, optional
+        Whether to read the functional connectivity data from the memory-mapped
+        store built by build_fc_store() instead of the per-subject files.
+    store_folder : str, optional
+        Only used if use_store is True.
+    dtype : np.dtype, optional
+        The functional connectivity data's dtype, the same for both sources.
+        Use np.float32 to halve its size. The store is saved as float32, so
+        with the default float64 its values are float32 precision.
 
     Returns
     -------
@@ -32,7 +47,11 @@ def get_data(wisc_level=5, label_path=ADHD):
         A tuple containing the functional connectivity data, cognition data,
         demographic data, and which population (ADHD or TD).
     """
-    fcs = get_fc_data()
+    if use_store:
+        fc_store, store_subject_ids = load_fc_store(store_folder)
+        fcs = get_fc_store_rows(store_subject_ids)
+    else:
+        fcs = get_fc_data(dtype=dtype)
     labels = get_label_data(label_path)
 
     subject_ids = labels.index
@@ -61,18 +80,28 @@ def get_data(wisc_level=5, label_path=ADHD):
     wiscs = _convert_dict_list_to_dict_numpy(wiscs)
     demographics = _convert_dict_list_to_dict_numpy(demographics)
 
-    return np.array(fc_matrices), wiscs, demographics, population
+    if use_store:
+        # Gather all of the subjects' rows in one read
+        X = fc_store[fc_matrices].astype(dtype, copy=False)
+        return X, wiscs, demographics, population
 
+    return np.array(fc_matrices, dtype=dtype), wiscs, demographics, population
 
-def get_fc_data():
+
+def get_fc_data(dtype=np.float64):
     """
     Gets the functional connectivity data.
 
+    Parameters
+    ----------
+    dtype : np.dtype, optional
+        The vectors' dtype.
+
     Returns
     -------
     fcs: dict
         A dictionary mapping subject ID to subject functional connectivity
-        matrix.
+        vector.
 
     """
     fc_paths = glob.glob(POWER_FC + f'/**/power_fc.npy', recursive=True)
@@ -81,11 +110,113 @@ def get_fc_data():
     for path in fc_paths:
         subject_id = get_subject_id_from_path(path)
         subject_fc = np.load(path)
-        fcs[subject_id] = to_power_fc_vector(subject_fc)
+        fcs[subject_id] = to_power_fc_vector(subject_fc).astype(
+            dtype, copy=False)
 
     return fcs
 
 
+def get_fc_store_rows(subject_ids):
+    """
+    Gets the row of each subject in the functional connectivity store.
+
+    Parameters
+    ----------
+    subject_ids : list
+        The subject ID for each row of the store, from load_fc_store().
+
+    Returns
+    -------
+    dict
+        A dictionary mapping subject ID to the subject's row in the store.
+
+    """
+    return {subject_id: row for row, subject_id in enumerate(subject_ids)}
+
+
+def build_fc_store(fc_folder=POWER_FC, store_folder=POWER_FC_STORE):
+    """
+    Packs every subject's functional connectivity vector into a single
+    on-disk matrix (subjects x 34716, float32) with a subject ID manifest.
+
+    The matrix is written as a NumPy array file so it can be opened with
+    np.memmap (see load_fc_store()), letting multiple processes share the
+    same pages instead of loading thousands of small files. Both files are
+    written under a temporary name (per process, so concurrent builds don't
+    write over each other) and then renamed so readers never see a partially
+    written store.
+
+    Parameters
+    ----------
+    fc_folder : str, optional
+        Folder containing the per-subject power_fc.npy files.
+    store_folder : str, optional
+
+    Returns
+    -------
+    tuple
+        The path to the matrix and the path to the manifest.
+
+    """
+    fc_paths = glob.glob(fc_folder + f'/**/power_fc.npy', recursive=True)
+
+    # Later paths override earlier ones, matching get_fc_data()
+    subject_paths = {get_subject_id_from_path(path): path for path in fc_paths}
+    subject_ids = list(subject_paths.keys())
+
+    os.makedirs(store_folder, exist_ok=True)
+    matrix_path = os.path.join(store_folder, FC_STORE_MATRIX)
+    manifest_path = os.path.join(store_folder, FC_STORE_MANIFEST)
+    tmp_matrix_path = f'{matrix_path}.{os.getpid()}.tmp'
+    tmp_manifest_path = f'{manifest_path}.{os.getpid()}.tmp'
+
+    fc_store = np.lib.format.open_memmap(
+        tmp_matrix_path, mode='w+', dtype=np.float32,
+        shape=(len(subject_ids), POWER_NUM_CONNECTIONS))
+
+    for row, subject_id in enumerate(subject_ids):
+        fc_store[row] = to_power_fc_vector(np.load(subject_paths[subject_id]))
+
+    fc_store.flush()
+    del fc_store
+
+    manifest = pd.DataFrame({'Subject': subject_ids})
+    manifest.to_csv(tmp_manifest_path, index_label='Row')
+
+    os.replace(tmp_matrix_path, matrix_path)
+    os.replace(tmp_manifest_path, manifest_path)
+
+    return matrix_path, manifest_path
+
+
+def load_fc_store(store_folder=POWER_FC_STORE):
+    """
+    Opens the functional connectivity store built by build_fc_store().
+
+    The matrix is memory-mapped read-only, so opening it is near-instant and
+    only the rows that are indexed are read from disk.
+
+    Parameters
+    ----------
+    store_folder : str, optional
+
+    Returns
+    -------
+    fc_store : np.memmap
+        Matrix (subjects x 34716) of functional connectivity vectors.
+    subject_ids : list
+        The subject ID for each row of the matrix.
+
+    """
+    matrix_path = os.path.join(store_folder, FC_STORE_MATRIX)
+    manifest_path = os.path.join(store_folder, FC_STORE_MANIFEST)
+
+    fc_store = np.load(matrix_path, mmap_mode='r')
+    manifest = pd.read_csv(manifest_path, index_col='Row', dtype={'Subject': str})
+
+    return fc_store, manifest['Subject'].tolist()
+
+
 def get_label_data(label_path):
     """
     Gets the label data as a Pandas dataframe.
@@ -184,7 +315,7 @@ def get_subjects(subject_folder, desired_subjects=None):
     return subjects
 
 
-def generate_fake_data(X, y):
+def generate_fake_data(X, y, random_state=None):
     """
     Generates a fake dataset that matches the shape of X and y.
 
@@ -195,6 +326,7 @@ def generate_fake_data(X, y):
     ----------
     X : np.array
     y : np.array
+    random_state : int or np.random.Generator, optional
 
     Returns
     -------
@@ -204,14 +336,16 @@ def generate_fake_data(X, y):
     X_mean, X_std = np.mean(X), np.std(X)
     y_mean, y_std = np.mean(y), np.std(y)
 
-    X_fake = np.random.default_rng().normal(X_mean, X_std, size=X.shape)
-    y_fake = np.random.default_rng().normal(y_mean, y_std, size=y.shape)
+    rng = np.random.default_rng(random_state)
+    X_fake = rng.normal(X_mean, X_std, size=X.shape).astype(X.dtype, copy=False)
+    y_fake = rng.normal(y_mean, y_std, size=y.shape)
 
     return X_fake, y_fake
 
 
 def filter_data_by_network(
-        X, network, only_within_network=False, keep_connections=False):
+        X, network, only_within_network=False, keep_connections=False,
+        inplace=False):
     """
     Filters the dataset by the given Power network.
 
@@ -220,33 +354,51 @@ def filter_data_by_network(
     change to the network connections or fill the unselected connections with
     zero (done to maintain original dataset shape).
 
+    To avoid copying X altogether, either zero the unselected connections in
+    place or select the connections inside the model with a NetworkSelector
+    (see common.network_selector).
+
     Parameters
     ----------
     X : np.array
-    network : str
+    network : str or list
+        One or more networks, see get_network_connection_mask().
     only_within_network : bool
     keep_connections : bool
+    inplace : bool, optional
+        Whether to zero the unselected connections in X itself instead of a
+        copy. Needs keep_connections and a writeable X.
 
     Returns
     -------
     np.array
 
+    Raises
+    ------
+    ValueError
+        If inplace is True but keep_connections is False (the shape changes)
+        or X is read-only (E.g. a memory-mapped store).
+
     """
-    vector_labels = get_power_fc_vector_labels(True)
+    if inplace and not keep_connections:
+        raise ValueError('inplace needs keep_connections=True, the network '
+                         'connections are otherwise returned as a copy')
+    if inplace and not X.flags.writeable:
+        raise ValueError('inplace needs a writeable X, use inplace=False for '
+                         'read-only (E.g. memory-mapped) data')
 
-    network_connection_indices = []
-    for index, connection in enumerate(vector_labels):
-        if (only_within_network and connection[0] == network and
-                connection[1] == network):
-            network_connection_indices.append(index)
-        elif connection[0] == network or connection[1] == network:
-            network_connection_indices.append(index)
+    mode = 'within' if only_within_network else 'touching'
+    network_connection_mask = get_network_connection_mask(network, mode)
 
     if keep_connections:
-        X_filtered = np.zeros(X.shape)
-        X_filtered[:, network_connection_indices] = X[:, network_connection_indices]
+        if inplace:
+            X[:, ~network_connection_mask] = 0
+            return X
+
+        X_filtered = np.zeros(X.shape, dtype=X.dtype)
+        X_filtered[:, network_connection_mask] = X[:, network_connection_mask]
     else:
-        X_filtered = X[:, network_connection_indices]
+        X_filtered = X[:, get_network_connection_indices(network, mode)]
 
     return X_filtered
 
@@ -0,0 +1,440 @@
+"""
+Holds the functions for computing intraclass correlations (ICC) between
+model weights (E.g. between age bins or between models).
+
+The ICCs are computed with array algebra for every WISC measure and bin or
+model pair at once, and match pingouin.intraclass_corr() for a single pair.
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy import stats
+
+from common.power_atlas import to_power_network_fc_vectors
+from common.scoring import get_n_chunks, get_permutation_seeds
+
+ICC_TYPES = ('ICC1', 'ICC2', 'ICC3')
+ICC_DESCRIPTIONS = {
+    'ICC1': 'Single raters absolute',
+    'ICC2': 'Single random raters',
+    'ICC3': 'Single fixed raters',
+}
+
+
+def calc_icc(ratings, icc_type='ICC2', alpha=0.05):
+    """
+    Calculates the single rater ICC of a batch of ratings.
+
+    Parameters
+    ----------
+    ratings : np.array
+        Ratings with shape (..., n_targets, n_raters), E.g. the weight of each
+        connection (target) in each bin (rater). The leading dimensions are
+        batched.
+    icc_type : str, optional
+        'ICC1' (one-way random effects), 'ICC2' (ICC(2,1), two-way random
+        effects, absolute agreement), or 'ICC3' (ICC(3,1), two-way mixed
+        effects, consistency).
+    alpha : float, optional
+        Significance level of the confidence interval.
+
+    Returns
+    -------
+    dict
+        Mapping of 'ICC', 'F', 'df1', 'df2', 'pval', and 'CI95%' to arrays of
+        the leading shape of ratings ('CI95%' has an extra last dimension of
+        the lower and upper bound).
+
+    Examples
+    --------
+    >>> weights = np.stack([ridge_weight, pls_weight], axis=-1)
+    >>> calc_icc(weights, 'ICC3')['ICC']
+    0.912
+
+    """
+    if icc_type not in ICC_TYPES:
+        raise ValueError(f'icc_type must be one of {ICC_TYPES}, got '
+                         f'{icc_type}')
+
+    ms = _calc_mean_squares(ratings)
+    n, k = ratings.shape[-2:]
+    msr, msc, mse, msw = ms['msr'], ms['msc'], ms['mse'], ms['msw']
+
+    if icc_type == 'ICC1':
+        icc = (msr - msw) / (msr + (k - 1) * msw)
+        f_value = msr / msw
+        df1, df2 = n - 1, n * (k - 1)
+    else:
+        f_value = msr / mse
+        df1, df2 = n - 1, (n - 1) * (k - 1)
+
+        if icc_type == 'ICC2':
+            icc = (msr - mse) / (msr + (k - 1) * mse + k * (msc - mse) / n)
+        else:
+            icc = (msr - mse) / (msr + (k - 1) * mse)
+
+    if icc_type == 'ICC2':
+        ci = _calc_icc2_ci(icc, msr, msc, mse, n, k, alpha)
+    else:
+        f_lower = f_value / stats.f.ppf(1 - alpha / 2, df1, df2)
+        f_upper = f_value * stats.f.ppf(1 - alpha / 2, df2, df1)
+        ci = np.stack([(f_lower - 1) / (f_lower + k - 1),
+                       (f_upper - 1) / (f_upper + k - 1)], axis=-1)
+
+    return {
+        'ICC': icc,
+        'F': f_value,
+        'df1': df1,
+        'df2': df2,
+        'pval': stats.f.sf(f_value, df1, df2),
+        'CI95%': ci,
+    }
+
+
+def bootstrap_icc_ci(ratings, icc_type='ICC2', n_boot=1000, alpha=0.05,
+                     n_jobs=None, random_state=None):
+    """
+    Calculates percentile bootstrap confidence intervals of a batch of ICCs
+    by resampling the targets (E.g. connections) with replacement.
+
+    Parameters
+    ----------
+    ratings : np.array
+        Ratings with shape (..., n_targets, n_raters), see calc_icc().
+    icc_type : str, optional
+    n_boot : int, optional
+    alpha : float, optional
+    n_jobs : int, optional
+        Number of jobs the bootstrap samples are split between.
+    random_state : int, optional
+        Each bootstrap sample gets its own seed, so the result doesn't depend
+        on n_jobs.
+
+    Returns
+    -------
+    np.array
+        The lower and upper bound with shape (..., 2).
+
+    """
+    seeds = get_permutation_seeds(n_boot, random_state)
+    seed_chunks = np.array_split(np.array(seeds, dtype=object),
+                                 get_n_chunks(n_boot, n_jobs))
+    boot_iccs = Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_icc)(ratings, icc_type, seed_chunk)
+        for seed_chunk in seed_chunks)
+    boot_iccs = np.concatenate(boot_iccs, axis=0)
+
+    return np.moveaxis(np.nanquantile(boot_iccs, [alpha / 2, 1 - alpha / 2],
+                                      axis=0), 0, -1)
+
+
+def between_bin_icc(model_weights, model, population, icc_types=ICC_TYPES,
+                    network_level=False, n_boot=0, n_jobs=None,
+                    random_state=None):
+    """
+    Calculates the ICCs between the model weights of every pair of age bins,
+    for every WISC measure.
+
+    Parameters
+    ----------
+    model_weights : dict
+        Mapping of bin to WISC measure to weight, from
+        load_all_model_weights().
+    model : str
+    population : str
+    icc_types : list, optional
+    network_level : bool, optional
+        Whether to average the weights within each network pair (see
+        to_power_network_fc_vectors()) before calculating the ICCs.
+    n_boot : int, optional
+        Number of bootstrap samples for the 'Bootstrap CI95%' column, no
+        bootstrap if 0.
+    n_jobs : int, optional
+    random_state : int, optional
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per WISC measure, bin pair, and ICC type.
+
+    Examples
+    --------
+    >>> ridge_weights = load_all_model_weights('ridge', 'adhd', True, False,
+    ...                                        lazy=True)
+    >>> between_bin_icc(ridge_weights, 'ridge', 'adhd', network_level=True)
+
+    """
+    weights, bin_labels, targets = stack_model_weights(model_weights)
+    pairs = list(itertools.combinations(range(len(bin_labels)), 2))
+
+    # (target, pair, connection, rater)
+    ratings = np.stack([weights[list(pair)] for pair in pairs], axis=0)
+    ratings = np.moveaxis(ratings, (0, 1, 2), (1, 3, 0))
+    if network_level:
+        ratings = _to_network_ratings(ratings)
+
+    keys = [{'Model': model, 'Population': population, 'Target': target,
+             'First Bin': bin_labels[first], 'Second Bin': bin_labels[second]}
+            for target in targets for first, second in pairs]
+
+    return _get_icc_results(ratings, keys, icc_types, n_boot, n_jobs,
+                            random_state)
+
+
+def between_model_icc(model_weights, population, icc_types=ICC_TYPES,
+                      network_level=False, n_boot=0, n_jobs=None,
+                      random_state=None):
+    """
+    Calculates the ICCs between the weights of every pair of models, for
+    every age bin and WISC measure.
+
+    Parameters
+    ----------
+    model_weights : dict
+        Mapping of model to the output of load_all_model_weights() (E.g.
+        {'ridge': ridge_weights, 'pls': pls_weights}).
+    population : str
+    icc_types : list, optional
+    network_level : bool, optional
+        Whether to average the weights within each network pair (see
+        to_power_network_fc_vectors()) before calculating the ICCs.
+    n_boot : int, optional
+        Number of bootstrap samples for the 'Bootstrap CI95%' column, no
+        bootstrap if 0.
+    n_jobs : int, optional
+    random_state : int, optional
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per model pair, age bin, WISC measure, and ICC type.
+
+    """
+    models = list(model_weights)
+    stacked = [stack_model_weights(model_weights[model]) for model in models]
+    _, bin_labels, targets = stacked[0]
+    for _, other_bin_labels, other_targets in stacked[1:]:
+        if other_bin_labels != bin_labels or other_targets != targets:
+            raise ValueError('All models must have the same bins and WISC '
+                             'measures')
+
+    pairs = list(itertools.combinations(range(len(models)), 2))
+
+    # (pair, bin, target, connection, rater)
+    ratings = np.stack([
+        np.stack([stacked[first][0], stacked[second][0]], axis=-1)
+        for first, second in pairs], axis=0)
+    if network_level:
+        ratings = _to_network_ratings(ratings)
+
+    keys = [{'First Model': models[first], 'Second Model': models[second],
+             'Population': population, 'Target': target, 'Bin': bin_label}
+            for first, second in pairs for bin_label in bin_labels
+            for target in targets]
+
+    return _get_icc_results(ratings, keys, icc_types, n_boot, n_jobs,
+                            random_state)
+
+
+def stack_model_weights(model_weights):
+    """
+    Stacks the weights from load_all_model_weights() into one array.
+
+    Parameters
+    ----------
+    model_weights : dict
+        Mapping of bin to WISC measure to weight.
+
+    Returns
+    -------
+    weights : np.array
+        Array with shape (n_bins, n_targets, n_connections).
+    bin_labels : list
+    targets : list
+
+    """
+    bin_labels = list(model_weights)
+    targets = list(model_weights[bin_labels[0]])
+    weights = np.stack([
+        np.stack([np.asarray(model_weights[bin_label][target],
+                             dtype=np.float64)
+                  for target in targets])
+        for bin_label in bin_labels])
+
+    return weights, bin_labels, targets
+
+
+def _calc_mean_squares(ratings):
+    """
+    Calculates the two-way ANOVA mean squares of a batch of ratings.
+
+    Parameters
+    ----------
+    ratings : np.array
+        Ratings with shape (..., n_targets, n_raters).
+
+    Returns
+    -------
+    dict
+        Mapping of 'msr' (targets), 'msc' (raters), 'mse' (residual), and
+        'msw' (within targets) to arrays of the leading shape of ratings.
+
+    """
+    n, k = ratings.shape[-2:]
+    grand_mean = ratings.mean(axis=(-2, -1), keepdims=True)
+
+    row_means = ratings.mean(axis=-1, keepdims=True)
+    col_means = ratings.mean(axis=-2, keepdims=True)
+
+    ss_total = ((ratings - grand_mean) ** 2).sum(axis=(-2, -1))
+    ss_rows = k * ((row_means - grand_mean) ** 2).sum(axis=(-2, -1))
+    ss_cols = n * ((col_means - grand_mean) ** 2).sum(axis=(-2, -1))
+    ss_error = ss_total - ss_rows - ss_cols
+
+    return {
+        'msr': ss_rows / (n - 1),
+        'msc': ss_cols / (k - 1),
+        'mse': ss_error / ((n - 1) * (k - 1)),
+        'msw': (ss_cols + ss_error) / (n * (k - 1)),
+    }
+
+
+def _calc_icc2_ci(icc, msr, msc, mse, n, k, alpha):
+    """
+    Calculates the confidence interval of ICC(2,1).
+
+    Helper function for calc_icc().
+
+    Parameters
+    ----------
+    icc : np.array
+    msr : np.array
+    msc : np.array
+    mse : np.array
+    n : int
+    k : int
+    alpha : float
+
+    Returns
+    -------
+    np.array
+        The lower and upper bound with shape (..., 2).
+
+    """
+    f_cols = msc / mse
+    icc_term = n * (1 + (k - 1) * icc) - k * icc
+    v_num = (k - 1) * (n - 1) * (k * icc * f_cols + icc_term) ** 2
+    v_den = (n - 1) * k ** 2 * icc ** 2 * f_cols ** 2 + icc_term ** 2
+    v = v_num / v_den
+
+    f_upper = stats.f.ppf(1 - alpha / 2, n - 1, v)
+    f_lower = stats.f.ppf(1 - alpha / 2, v, n - 1)
+    error_term = k * msc + (k * n - k - n) * mse
+    lower = n * (msr - f_upper * mse) / (f_upper * error_term + n * msr)
+    upper = n * (f_lower * msr - mse) / (error_term + n * f_lower * msr)
+
+    return np.stack([lower, upper], axis=-1)
+
+
+def _bootstrap_icc(ratings, icc_type, seeds):
+    """
+    Calculates the ICCs of bootstrap samples of the targets.
+
+    Helper function for bootstrap_icc_ci().
+
+    Parameters
+    ----------
+    ratings : np.array
+    icc_type : str
+    seeds : list
+        One np.random.SeedSequence per bootstrap sample.
+
+    Returns
+    -------
+    np.array
+        Array with shape (len(seeds),) + the leading shape of ratings.
+
+    """
+    n = ratings.shape[-2]
+    boot_iccs = []
+
+    for seed in seeds:
+        sample = np.random.default_rng(seed).integers(n, size=n)
+        boot_iccs.append(calc_icc(ratings[..., sample, :], icc_type)['ICC'])
+
+    return np.array(boot_iccs)
+
+
+def _to_network_ratings(ratings):
+    """
+    Averages the connection ratings within each network pair.
+
+    Parameters
+    ----------
+    ratings : np.array
+        Ratings with shape (..., n_connections, n_raters).
+
+    Returns
+    -------
+    np.array
+        Ratings with shape (..., n_network_pairs, n_raters).
+
+    """
+    connections_last = np.moveaxis(ratings, -1, -2)
+    lead_shape = connections_last.shape[:-1]
+    network_ratings = to_power_network_fc_vectors(
+        connections_last.reshape(-1, connections_last.shape[-1]))
+
+    return np.moveaxis(network_ratings.reshape(lead_shape + (-1,)), -1, -2)
+
+
+def _get_icc_results(ratings, keys, icc_types, n_boot, n_jobs, random_state):
+    """
+    Calculates the ICCs of a batch of ratings and puts them in a table like
+    pingouin.intraclass_corr().
+
+    Parameters
+    ----------
+    ratings : np.array
+        Ratings with shape (..., n_targets, n_raters), where the leading
+        dimensions flatten to one row per key.
+    keys : list
+        The identifying columns of each row.
+    icc_types : list
+    n_boot : int
+    n_jobs : int
+    random_state : int
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    ratings = ratings.reshape((len(keys),) + ratings.shape[-2:])
+    results = []
+
+    for icc_type in icc_types:
+        icc = calc_icc(ratings, icc_type)
+        if n_boot:
+            boot_ci = bootstrap_icc_ci(ratings, icc_type, n_boot,
+                                       n_jobs=n_jobs, random_state=random_state)
+
+        for i, key in enumerate(keys):
+            result = {
+                **key,
+                'Type': icc_type,
+                'Description': ICC_DESCRIPTIONS[icc_type],
+                'ICC': icc['ICC'][i],
+                'F': icc['F'][i],
+                'df1': icc['df1'],
+                'df2': icc['df2'],
+                'pval': icc['pval'][i],
+                'CI95%': icc['CI95%'][i],
+            }
+            if n_boot:
+                result['Bootstrap CI95%'] = boot_ci[i]
+            results.append(result)
+
+    return pd.DataFrame(results)
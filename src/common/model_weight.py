@@ -1,16 +1,21 @@
 """
 Holds the functions for saving and loading model weights.
 """
+import json
 import os
 
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
 
 from common.binning import BIN_LABELS
 from common.paths import PLS_WEIGHTS, RIDGE_WEIGHTS
+from common.scoring import unimetric_scorer
 from common.wisc import WISC_LEVEL
 
 
-def save_model_weight(model, population, measure, age_group, model_weight, average=True, intercept=False):
+def save_model_weight(model, population, measure, age_group, model_weight,
+                      average=True, intercept=False, archive=False):
     """
     Saves the feature/model weights for a specific model, diagnosis,
     WISC measure, and age bin.
@@ -24,23 +29,38 @@ def save_model_weight(model, population, measure, age_group, model_weight, avera
     model_weight : np.array
     average : bool
     intercept : bool
+    archive : bool, optional
+        Whether to also write the weights into the model weight archive (see
+        build_model_weight_archive()), creating it if needed.
 
     Returns
     -------
     str
         Location of the saved model weight.
+
+    Raises
+    ------
+    ValueError
+        If archive is True and the archive has no cell for the WISC measure
+        and age bin (E.g. 'Bin 2 Equal') or holds weights of another shape.
     
     """
-    filename = f'{model}_{population}_{measure}_{age_group}{"_inte" if intercept else "_coef"}{"_avg" if average else ""}.npy'
-    model_weight_folder = PLS_WEIGHTS if model == 'pls' else RIDGE_WEIGHTS
-        
-    filepath = os.path.join(model_weight_folder, filename)
+    if archive:
+        _check_model_weight_archive_cell(population, measure, age_group)
+
+    filepath = get_model_weight_path(model, population, measure, age_group,
+                                     average, intercept)
     np.save(filepath, model_weight)
+
+    if archive:
+        _write_model_weight_archive(model, population, measure, age_group,
+                                    model_weight, average, intercept)
     
     return filepath
 
 
-def load_model_weight(model, population, measure, age_group, average=True, intercept=False):
+def load_model_weight(model, population, measure, age_group, average=True,
+                      intercept=False):
     """
     Loads the feature/model weights for a specific model, diagnosis,
     WISC measure, and age bin.
@@ -59,14 +79,344 @@ def load_model_weight(model, population, measure, age_group, average=True, inter
     np.array
 
     """
-    filename = f'{model}_{population}_{measure}_{age_group}{"_inte" if intercept else "_coef"}{"_avg" if average else ""}.npy'
-    model_weight_folder = PLS_WEIGHTS if model == 'pls' else RIDGE_WEIGHTS
-    
-    filepath = os.path.join(model_weight_folder, filename)
+    filepath = get_model_weight_path(model, population, measure, age_group,
+                                     average, intercept)
     return np.load(filepath)
 
 
-def load_all_model_weights(model, population, average, intercept):
+class FoldWeightAccumulator:
+    """
+    Streaming summary of model weights across cross-validation folds.
+
+    Keeps a running mean, variance, and sign consistency of the weights
+    (Welford's algorithm) so the weights of each fold can be dropped after
+    they're added. The weights of each fold can optionally be written to disk
+    as they're added, in the same format as save_model_weight(average=False).
+
+    Parameters
+    ----------
+    n_folds : int, optional
+        Number of folds that will be added, needed to write the weights of
+        each fold.
+    fold_path : str, optional
+        Location to write the weights of each fold.
+
+    Attributes
+    ----------
+    n_added_ : int
+        Number of folds added so far.
+    mean_ : np.array
+    m2_ : np.array
+        Running sum of squared differences from the mean.
+    n_positive_ : np.array
+        Number of folds with a positive weight.
+    n_negative_ : np.array
+        Number of folds with a negative weight.
+
+    Examples
+    --------
+    >>> accumulator = FoldWeightAccumulator()
+    >>> for estimator in scores['estimator']:
+    ...     accumulator.add(estimator['ridge'].coef_)
+    >>> accumulator.mean_.shape, accumulator.sign_consistency.shape
+    ((34716,), (34716,))
+
+    """
+    def __init__(self, n_folds=None, fold_path=None):
+        if fold_path is not None and n_folds is None:
+            raise ValueError('n_folds is needed to write the weights of each '
+                             'fold')
+
+        self.n_folds = n_folds
+        self.fold_path = fold_path
+        self.n_added_ = 0
+        self.mean_ = None
+        self.m2_ = None
+        self.n_positive_ = None
+        self.n_negative_ = None
+        self._fold_weights = None
+
+    def add(self, weight):
+        """
+        Adds the weights of one fold.
+
+        Parameters
+        ----------
+        weight : np.array
+
+        Returns
+        -------
+        FoldWeightAccumulator
+            The accumulator, to chain calls.
+
+        """
+        weight = np.asarray(weight, dtype=np.float64)
+
+        if self.mean_ is None:
+            self.mean_ = np.zeros(weight.shape)
+            self.m2_ = np.zeros(weight.shape)
+            self.n_positive_ = np.zeros(weight.shape, dtype=np.int32)
+            self.n_negative_ = np.zeros(weight.shape, dtype=np.int32)
+
+            if self.fold_path is not None:
+                self._fold_weights = np.lib.format.open_memmap(
+                    self.fold_path + '.tmp', mode='w+', dtype=np.float64,
+                    shape=(self.n_folds,) + weight.shape)
+        elif weight.shape != self.mean_.shape:
+            raise ValueError(f'Expected weights of shape {self.mean_.shape}, '
+                             f'got {weight.shape}')
+
+        if self._fold_weights is not None:
+            if self.n_added_ >= self.n_folds:
+                raise ValueError(f'More than n_folds={self.n_folds} folds '
+                                 f'added')
+            self._fold_weights[self.n_added_] = weight
+
+        self.n_added_ += 1
+        delta = weight - self.mean_
+        self.mean_ += delta / self.n_added_
+        self.m2_ += delta * (weight - self.mean_)
+        self.n_positive_ += weight > 0
+        self.n_negative_ += weight < 0
+
+        return self
+
+    @property
+    def var_(self):
+        """
+        Sample variance of the weights across the added folds.
+
+        Returns
+        -------
+        np.array
+            NaN where fewer than two folds were added.
+
+        """
+        if self.n_added_ < 2:
+            return np.full_like(self.mean_, np.nan)
+
+        return self.m2_ / (self.n_added_ - 1)
+
+    @property
+    def sign_consistency(self):
+        """
+        Fraction of the added folds where the weight has its most common
+        sign.
+
+        Returns
+        -------
+        np.array
+
+        """
+        return np.maximum(self.n_positive_, self.n_negative_) / self.n_added_
+
+    def close(self):
+        """
+        Finishes writing the weights of each fold, if they're written.
+
+        Returns
+        -------
+        str or None
+            Location of the weights of each fold.
+
+        """
+        if self._fold_weights is None:
+            return None
+
+        if self.n_added_ != self.n_folds:
+            raise ValueError(f'Expected {self.n_folds} folds, '
+                             f'got {self.n_added_}')
+
+        self._fold_weights.flush()
+        self._fold_weights = None
+        os.replace(self.fold_path + '.tmp', self.fold_path)
+
+        return self.fold_path
+
+
+def get_model_weight_path(model, population, measure, age_group, average=True,
+                          intercept=False, summary=''):
+    """
+    Gets the location of the feature/model weights for a specific model,
+    diagnosis, WISC measure, and age bin.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    measure : str
+    age_group : str
+    average : bool, optional
+    intercept : bool, optional
+    summary : str, optional
+        Suffix of a summary across folds ('var' or 'sign'), instead of the
+        average or the weights of each fold.
+
+    Returns
+    -------
+    str
+
+    """
+    if summary:
+        suffix = f'_{summary}'
+    else:
+        suffix = '_avg' if average else ''
+
+    weight_type = '_inte' if intercept else '_coef'
+    filename = (f'{model}_{population}_{measure}_{age_group}{weight_type}'
+                f'{suffix}.npy')
+    model_weight_folder = PLS_WEIGHTS if model == 'pls' else RIDGE_WEIGHTS
+
+    return os.path.join(model_weight_folder, filename)
+
+
+def save_model_weight_summary(model, population, measure, age_group,
+                              accumulator, intercept=False, archive=False):
+    """
+    Saves the average, variance, and sign consistency of the weights across
+    folds for a specific model, diagnosis, WISC measure, and age bin.
+
+    The average is saved like save_model_weight(average=True), and the
+    variance and sign consistency are saved next to it with a '_var' and
+    '_sign' suffix.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    measure : str
+    age_group : str
+    accumulator : FoldWeightAccumulator
+    intercept : bool, optional
+    archive : bool, optional
+        Whether to also write the average into the model weight archive.
+
+    Returns
+    -------
+    list
+        Locations of the saved average, variance, and sign consistency.
+
+    """
+    filepaths = [save_model_weight(model, population, measure, age_group,
+                                   accumulator.mean_, True, intercept, archive)]
+
+    for summary, summary_weight in (('var', accumulator.var_),
+                                    ('sign', accumulator.sign_consistency)):
+        filepath = get_model_weight_path(model, population, measure, age_group,
+                                         intercept=intercept, summary=summary)
+        np.save(filepath, summary_weight)
+        filepaths.append(filepath)
+
+    return filepaths
+
+
+def cross_validate_model_weights(estimator, X, y, cv, scorer=None, step=None,
+                                 coef_path=None, intercept_path=None,
+                                 n_jobs=None):
+    """
+    Cross-validates a linear estimator and accumulates its weights across
+    folds batch by batch, instead of keeping every fitted estimator.
+
+    Parameters
+    ----------
+    estimator : sklearn.base.BaseEstimator
+        Linear estimator or pipeline ending in a linear estimator.
+    X : np.array
+    y : np.array
+    cv : sklearn.model_selection.BaseCrossValidator
+    scorer : callable, optional
+        Called as scorer(estimator, X_test, y_test), unimetric_scorer() if
+        not given.
+    step : str, optional
+        Name of the pipeline step with the weights, the last step if not
+        given.
+    coef_path : str, optional
+        Location to write the coefficients of each fold, like
+        get_model_weight_path(average=False).
+    intercept_path : str, optional
+        Location to write the intercepts of each fold, like
+        get_model_weight_path(average=False, intercept=True).
+    n_jobs : int, optional
+
+    Returns
+    -------
+    test_scores : np.array
+    coef_accumulator : FoldWeightAccumulator
+    intercept_accumulator : FoldWeightAccumulator
+
+    Examples
+    --------
+    >>> pipe = make_pipeline(StandardScaler(), Ridge(alpha=best_alpha))
+    >>> scores, coefs, intercepts = cross_validate_model_weights(
+    ...     pipe, X_cv, y_cv, RKF_10_10, n_jobs=-1)
+    >>> save_model_weight_summary('ridge', population, target, bin_label, coefs)
+
+    """
+    if scorer is None:
+        scorer = unimetric_scorer
+
+    splits = list(cv.split(X, y))
+    coef_accumulator = FoldWeightAccumulator(len(splits), coef_path)
+    intercept_accumulator = FoldWeightAccumulator(len(splits), intercept_path)
+
+    # Fit the folds in batches of a few folds per worker, adding each batch's
+    # weights before the next batch starts so only one batch is kept
+    batch_size = 4 * effective_n_jobs(n_jobs)
+    test_scores = np.zeros(len(splits))
+
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(splits), batch_size):
+            fold_results = parallel(
+                delayed(_fit_fold_weights)(clone(estimator), X, y, train,
+                                           test, scorer, step)
+                for train, test in splits[start:start + batch_size])
+
+            for i, (score, coef, intercept) in enumerate(fold_results,
+                                                         start=start):
+                test_scores[i] = score
+                coef_accumulator.add(coef)
+                intercept_accumulator.add(intercept)
+
+    coef_accumulator.close()
+    intercept_accumulator.close()
+
+    return test_scores, coef_accumulator, intercept_accumulator
+
+
+def _fit_fold_weights(estimator, X, y, train, test, scorer, step):
+    """
+    Fits an estimator on one fold and gets its test score and weights.
+
+    Helper function for cross_validate_model_weights().
+
+    Parameters
+    ----------
+    estimator : sklearn.base.BaseEstimator
+    X : np.array
+    y : np.array
+    train : np.array
+    test : np.array
+    scorer : callable
+    step : str or None
+
+    Returns
+    -------
+    tuple
+        The test score, coefficients, and intercept.
+
+    """
+    estimator.fit(X[train], y[train])
+    score = scorer(estimator, X[test], y[test])
+
+    if hasattr(estimator, 'steps'):
+        linear_model = estimator[-1] if step is None else estimator[step]
+    else:
+        linear_model = estimator
+
+    return score, linear_model.coef_, np.asarray(linear_model.intercept_)
+
+
+def load_all_model_weights(model, population, average, intercept, lazy=False):
     """
     Loads all model weights for a specific model and diagnosis.
 
@@ -74,12 +424,24 @@ def load_all_model_weights(model, population, average, intercept):
     ----------
     model : str
     population : str
+    average : bool
+    intercept : bool
+    lazy : bool, optional
+        Whether to get the weights as memory-mapped views of the model weight
+        archive (see build_model_weight_archive()) instead of loading every
+        weight file.
 
     Returns
     -------
     dict
         Mapping of bin to cognitive measure to feature weight.
 
+    Raises
+    ------
+    FileNotFoundError
+        If a weight hasn't been saved, either as a weight file or (if lazy)
+        in the archive.
+
     Examples
     --------
     >>> model_weights = load_all_model_weights(model, population)
@@ -87,16 +449,276 @@ def load_all_model_weights(model, population, average, intercept):
     dict_keys(['All', 'Bin 1', 'Bin 2', 'Bin 3']) (34716,)
 
     """
-    labels = BIN_LABELS if population == 'adhd' else BIN_LABELS[:1]
+    if lazy:
+        weights, bin_labels, targets = load_model_weight_archive(
+            model, population, average, intercept)
+
+        # Cells that were never saved are still NaN, checking their first
+        # value only reads one page of each cell
+        first_values = weights.reshape(weights.shape[:2] + (-1,))[:, :, 0]
+        missing = [f'{bin_labels[bin_idx]} {targets[target_idx]}'
+                   for bin_idx, target_idx in zip(*np.nonzero(
+                       np.isnan(first_values)))]
+        if missing:
+            raise FileNotFoundError(
+                f'The {model} {population} model weight archive has no '
+                f'weights for: {", ".join(missing)}')
+
+        return {bin_label: {target: weights[bin_idx, target_idx]
+                            for target_idx, target in enumerate(targets)}
+                for bin_idx, bin_label in enumerate(bin_labels)}
+
+    labels = _get_population_bin_labels(population)
     model_weights = {k: None for k in labels}
 
     for bin_label in labels:
         bin_weights = {k: None for k in WISC_LEVEL[5]}
 
         for target in WISC_LEVEL[5]:
-            bin_weights[target] = load_model_weight(model, population, target,
-                                                    bin_label, average, intercept)
+            bin_weights[target] = load_model_weight(
+                model, population, target, bin_label, average, intercept)
 
         model_weights[bin_label] = bin_weights
 
     return model_weights
+
+
+def build_model_weight_archive(model, population, average=True,
+                               intercept=False):
+    """
+    Packs all model weights for a specific model and diagnosis into one
+    archive array (bin x WISC measure x weight shape) with an index of the
+    bins and measures.
+
+    The archive is a NumPy array file that's memory-mapped when loaded, so
+    loading all weights opens one file instead of one file per bin and
+    measure, and only the weights that are used are read from disk.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    average : bool, optional
+    intercept : bool, optional
+
+    Returns
+    -------
+    str
+        Location of the archive.
+
+    """
+    bin_labels, targets = _get_population_bin_labels(population), WISC_LEVEL[5]
+    archive_path, index_path = _get_model_weight_archive_paths(
+        model, population, average, intercept)
+    tmp_path = f'{archive_path}.{os.getpid()}.tmp'
+
+    archive = None
+    for bin_idx, bin_label in enumerate(bin_labels):
+        for target_idx, target in enumerate(targets):
+            model_weight = load_model_weight(
+                model, population, target, bin_label, average, intercept)
+
+            if archive is None:
+                archive = np.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=model_weight.dtype,
+                    shape=(len(bin_labels), len(targets)) + model_weight.shape)
+            archive[bin_idx, target_idx] = model_weight
+
+    archive.flush()
+    del archive
+
+    _save_model_weight_archive_index(index_path, bin_labels, targets)
+    os.replace(tmp_path, archive_path)
+
+    return archive_path
+
+
+def load_model_weight_archive(model, population, average=True, intercept=False):
+    """
+    Loads the model weight archive for a specific model and diagnosis.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    average : bool, optional
+    intercept : bool, optional
+
+    Returns
+    -------
+    weights : np.memmap
+        Read-only array (bin x WISC measure x weight shape), weights that
+        haven't been saved yet are NaN.
+    bin_labels : list
+    targets : list
+
+    Examples
+    --------
+    >>> weights, bin_labels, targets = load_model_weight_archive('ridge',
+    ...                                                          'adhd')
+    >>> print(weights.shape, bin_labels, targets)
+    (4, 6, 34716) ['All', 'Bin 1', 'Bin 2', 'Bin 3'] ['WISC_FSIQ', ...]
+
+    """
+    archive_path, index_path = _get_model_weight_archive_paths(
+        model, population, average, intercept)
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    return np.load(archive_path, mmap_mode='r'), index['bins'], index['targets']
+
+
+def _write_model_weight_archive(model, population, measure, age_group,
+                                model_weight, average, intercept):
+    """
+    Writes one model weight into the model weight archive, creating an
+    archive filled with NaN if it doesn't exist.
+
+    Helper function for save_model_weight().
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    measure : str
+    age_group : str
+    model_weight : np.array
+    average : bool
+    intercept : bool
+
+    Returns
+    -------
+    None
+
+    """
+    bin_labels, targets = _get_population_bin_labels(population), WISC_LEVEL[5]
+    archive_path, index_path = _get_model_weight_archive_paths(
+        model, population, average, intercept)
+    model_weight = np.asarray(model_weight)
+
+    if not os.path.exists(archive_path):
+        # Each process writes its own empty archive and only publishes it if
+        # no other process has, so a cell another process already wrote is
+        # never replaced with NaN
+        tmp_path = f'{archive_path}.{os.getpid()}.tmp'
+        archive = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float64,
+            shape=(len(bin_labels), len(targets)) + model_weight.shape)
+        archive[:] = np.nan
+        del archive
+
+        _save_model_weight_archive_index(index_path, bin_labels, targets)
+        try:
+            os.link(tmp_path, archive_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+
+    with open(index_path) as f:
+        index = json.load(f)
+
+    archive = np.load(archive_path, mmap_mode='r+')
+    if archive.shape[2:] != model_weight.shape:
+        raise ValueError(f'The model weight archive {archive_path} holds '
+                         f'weights of shape {archive.shape[2:]}, got '
+                         f'{model_weight.shape}')
+
+    archive[index['bins'].index(age_group),
+            index['targets'].index(measure)] = model_weight
+    archive.flush()
+
+
+def _check_model_weight_archive_cell(population, measure, age_group):
+    """
+    Checks that the model weight archive has a cell for the WISC measure and
+    age bin.
+
+    Parameters
+    ----------
+    population : str
+    measure : str
+    age_group : str
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ValueError
+        If the archive has no cell for the WISC measure or age bin.
+
+    """
+    bin_labels = _get_population_bin_labels(population)
+
+    if age_group not in bin_labels:
+        raise ValueError(f'The {population} model weight archive only has the '
+                         f'bins {bin_labels}, got {age_group!r}')
+    if measure not in WISC_LEVEL[5]:
+        raise ValueError(f'The model weight archive only has the WISC '
+                         f'measures {WISC_LEVEL[5]}, got {measure!r}')
+
+
+def _save_model_weight_archive_index(index_path, bin_labels, targets):
+    """
+    Saves the bins and WISC measures of a model weight archive.
+
+    Parameters
+    ----------
+    index_path : str
+    bin_labels : list
+    targets : list
+
+    Returns
+    -------
+    None
+
+    """
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'bins': list(bin_labels), 'targets': list(targets)}, f)
+    os.replace(tmp_path, index_path)
+
+
+def _get_model_weight_archive_paths(model, population, average, intercept):
+    """
+    Gets the locations of the model weight archive and its index.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    average : bool
+    intercept : bool
+
+    Returns
+    -------
+    tuple
+        The archive path and the index path.
+
+    """
+    weight_type = '_inte' if intercept else '_coef'
+    suffix = '_avg' if average else ''
+    filename = f'{model}_{population}{weight_type}{suffix}_archive'
+    model_weight_folder = PLS_WEIGHTS if model == 'pls' else RIDGE_WEIGHTS
+
+    return (os.path.join(model_weight_folder, f'{filename}.npy'),
+            os.path.join(model_weight_folder, f'{filename}.json'))
+
+
+def _get_population_bin_labels(population):
+    """
+    Gets the age bins that have model weights for a diagnosis.
+
+    Parameters
+    ----------
+    population : str
+
+    Returns
+    -------
+    list
+
+    """
+    return BIN_LABELS if population == 'adhd' else BIN_LABELS[:1]
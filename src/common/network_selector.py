@@ -0,0 +1,93 @@
+"""
+Holds the sklearn transformer for selecting Power network connections inside
+a model, kept apart from common.data so loading the data doesn't import
+sklearn.
+"""
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from common.power_atlas import (
+    POWER_NUM_CONNECTIONS, get_network_connection_indices)
+
+
+class NetworkSelector(BaseEstimator, TransformerMixin):
+    """
+    Transformer that selects the connections of one or more Power networks.
+
+    Used as the first step of a pipeline so each fold only copies the selected
+    connections, instead of filtering (and zero-filling) the whole dataset up
+    front. For linear models, this gives the same predictions as training on
+    zero-filled data, and inverse_transform() maps the model weights back to
+    the full Power FC vector (34716 x 1) with zeros for the other connections.
+
+    Parameters
+    ----------
+    network : str or list
+        One or more networks, see get_network_connection_mask().
+    mode : str, optional
+        Connection selection mode, see get_network_connection_mask().
+
+    Examples
+    --------
+    >>> pipe = make_pipeline(NetworkSelector('DMN'), StandardScaler(),
+    ...                      Ridge())
+    >>> scores = cross_validate(pipe, X, y, cv=RKF_10_10)
+
+    """
+    def __init__(self, network, mode='touching'):
+        self.network = network
+        self.mode = mode
+
+    def fit(self, X, y=None):
+        """
+        Does nothing, the selection doesn't depend on the data.
+
+        Parameters
+        ----------
+        X : np.array
+        y : np.array, optional
+
+        Returns
+        -------
+        self
+
+        """
+        return self
+
+    def transform(self, X):
+        """
+        Selects the network connections from X.
+
+        Parameters
+        ----------
+        X : np.array
+
+        Returns
+        -------
+        np.array
+
+        """
+        return X[:, get_network_connection_indices(self.network, self.mode)]
+
+    def inverse_transform(self, X):
+        """
+        Places the selected connections back into full Power FC vectors, with
+        zeros for the other connections.
+
+        Parameters
+        ----------
+        X : np.array
+            Either one vector (E.g. model weights) or a batch of vectors.
+
+        Returns
+        -------
+        np.array
+
+        """
+        X = np.asarray(X)
+        indices = get_network_connection_indices(self.network, self.mode)
+        X_full = np.zeros(X.shape[:-1] + (POWER_NUM_CONNECTIONS,),
+                          dtype=X.dtype)
+        X_full[..., indices] = X
+
+        return X_full
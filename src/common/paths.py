@@ -16,12 +16,16 @@ IMAGES = join(REPO_DIR, 'images')
 RAW_POWER = join(SCRATCH_DATA, 'power_atlas_labels.xls')
 # POWER = join(SCRATCH_DATA, 'power_atlas_labels.csv')
 POWER = join(SCRATCH_DATA, 'power_atlas_labels (extrapolate).csv')
+# Offline copy of the Power atlas coordinates from nilearn
+POWER_COORDS_FILE = join(SCRATCH_DATA, 'power_atlas_coords.csv')
 
 # Bad subjects
 BAD_SUBJECTS = join(SCRATCH_DATA, 'bad_subjects.csv')
 
 # Functional connectivity
 POWER_FC = join(BPHO_DIR, 'python_power_fc')
+POWER_FC_STORE = join(BPHO_DIR, 'python_power_fc_store')
+POWER_FC_CACHE = join(BPHO_DIR, 'python_power_fc_cache')
 
 # WISC
 RAW_WISC = join(BIOBANK_LABELS, 'Labels_Feb2_2021.csv')
@@ -47,9 +51,14 @@ PLS_RESULTS = join(MODEL_RESULTS, 'PLS')
 RIDGE_RESULTS = join(MODEL_RESULTS, 'Ridge')
 CROSS_PRED_RESULTS = join(MODEL_RESULTS, 'Cross Prediction')
 ICC_RESULTS = join(MODEL_RESULTS, 'ICC')
+MODEL_RESULTS_DB = join(MODEL_RESULTS, 'model_results.sqlite')
 
 # Permutation scores
 PERM_SCORES = join(SCRATCH_DATA, 'permutation_scores')
 RIDGE_PSCORES = join(PERM_SCORES, 'Ridge')
 PLS_PSCORES = join(PERM_SCORES, 'PLS')
 CROSS_PRED_PSCORES = join(PERM_SCORES, 'Cross Prediction')
+CROSS_PRED_SCALED_PSCORES = join(CROSS_PRED_PSCORES, 'Standard Scaled')
+
+# Out-of-fold predictions
+CROSS_PRED_PREDICTIONS = join(SCRATCH_DATA, 'cross_prediction_predictions')
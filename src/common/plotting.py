@@ -7,7 +7,7 @@ from mne_connectivity.viz import plot_connectivity_circle
 from nilearn import plotting
 
 from common.power_atlas import (
-    POWER_COORDS, POWER_LEGEND, POWER_NODE_COLORS, to_power_fc_matrix)
+    POWER_LEGEND, get_power_coords, get_power_node_colors, to_power_fc_matrix)
 
 DEFAULT_CMAP = 'bwr'
 POS_CMAP = 'YlOrRd'
@@ -105,8 +105,8 @@ def plot_fc_graph(
 
     """
     plotting.plot_connectome(
-        fc, POWER_COORDS, node_size=5, colorbar=True,
-        node_color=POWER_NODE_COLORS, edge_vmin=emin, edge_vmax=emax,
+        fc, get_power_coords(), node_size=5, colorbar=True,
+        node_color=list(get_power_node_colors()), edge_vmin=emin, edge_vmax=emax,
         edge_cmap=cmap, edge_threshold=threshold, title=title)
 
 
@@ -126,8 +126,9 @@ def plot_node_strengths(node_strength, threshold=None, cmap=DEFAULT_CMAP):
     None
 
     """
-    plotting.plot_markers(node_strength, POWER_COORDS, node_threshold=threshold,
-                          node_vmin=0, node_vmax=1, node_cmap=cmap)
+    plotting.plot_markers(node_strength, get_power_coords(),
+                          node_threshold=threshold, node_vmin=0, node_vmax=1,
+                          node_cmap=cmap)
 
 
 def plot_circular_graph(
@@ -1,22 +1,23 @@
 """
 Holds the functions and constants for manipulating the Power et al. (2014) atlas.
 """
-import matplotlib.patches as mpatches
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
-from nilearn import datasets
-from nilearn.connectome import ConnectivityMeasure
-from nilearn.maskers import NiftiSpheresMasker
 
-from common.paths import POWER
+from common.paths import POWER, POWER_COORDS_FILE, POWER_FC, POWER_FC_CACHE
 
+# Heavy dependencies (nilearn, matplotlib, joblib) are imported inside the
+# functions that need them, and the atlas files are read on first use, so
+# importing this module stays cheap.
 POWER_NUM_NODES = 264
+POWER_NUM_CONNECTIONS = POWER_NUM_NODES * (POWER_NUM_NODES - 1) // 2
 POWER_NUM_NETWORKS = 13
-POWER_DATASET = datasets.fetch_coords_power_2011(legacy_format=False)
-POWER_COORDS = np.vstack((POWER_DATASET.rois['x'], POWER_DATASET.rois['y'],
-                          POWER_DATASET.rois['z'])).T
-POWER_LABELS = pd.read_csv(POWER, index_col='ROI')
-POWER_NODE_COLORS = POWER_LABELS['Color'].values.tolist()
 POWER_NETWORKS = {
     'VIS': 'Visual',
     'FPN': 'Fronto-parietal Task Control',
@@ -53,7 +54,70 @@ POWER_LEGEND = {
 }
 
 
-def generate_power_fc_matrix(file, kind='correlation'):
+@lru_cache(maxsize=None)
+def get_power_coords():
+    """
+    Gets the Power atlas ROI coordinates (264 x 3) in MNI space.
+
+    Reads the offline copy of the coordinates and only falls back to nilearn's
+    dataset fetcher if the copy is missing. Cached after the first call.
+
+    Returns
+    -------
+    np.array
+
+    """
+    if os.path.exists(POWER_COORDS_FILE):
+        rois = pd.read_csv(POWER_COORDS_FILE, index_col='ROI')
+        return rois[['X', 'Y', 'Z']].values
+
+    from nilearn import datasets
+
+    power_dataset = datasets.fetch_coords_power_2011(legacy_format=False)
+
+    return np.vstack((power_dataset.rois['x'], power_dataset.rois['y'],
+                      power_dataset.rois['z'])).T
+
+
+@lru_cache(maxsize=None)
+def get_power_labels():
+    """
+    Gets the Power atlas ROI labels (color and system/network per ROI).
+
+    Cached after the first call, so don't modify the returned dataframe.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    return pd.read_csv(POWER, index_col='ROI')
+
+
+@lru_cache(maxsize=None)
+def get_power_node_colors():
+    """
+    Gets the color of each Power atlas ROI.
+
+    Returns
+    -------
+    tuple
+
+    """
+    return tuple(get_power_labels()['Color'].values.tolist())
+
+
+# Reduction functions with a vectorized equivalent in
+# to_power_network_fc_vectors()
+_NETWORK_REDUCTION_FUNCS = {
+    np.mean: 'mean',
+    np.sum: 'sum',
+    np.max: 'max',
+}
+
+
+def generate_power_fc_matrix(file, kind='correlation', smoothing_fwhm=6,
+                             radius=5.):
     """
     Generates a Power functional connectivity matrix from a set of fMRI images
     (nifti).
@@ -62,25 +126,294 @@ def generate_power_fc_matrix(file, kind='correlation'):
 
     Parameters
     ----------
-    file : str
+    file : str or list
+        A 4D nifti or a list of 3D niftis making up one subject's scan.
     kind : str
+    smoothing_fwhm : float, optional
+    radius : float, optional
 
     Returns
     -------
     correlation_matrix : np.array
 
     """
+    from nilearn.connectome import ConnectivityMeasure
+    from nilearn.maskers import NiftiSpheresMasker
+
     spheres_masker = NiftiSpheresMasker(
-        seeds=POWER_COORDS, smoothing_fwhm=6, radius=5., standardize=True)
+        seeds=get_power_coords(), smoothing_fwhm=smoothing_fwhm, radius=radius,
+        standardize=True)
     time_series = spheres_masker.fit_transform(file)
 
-    correlation_measure = ConnectivityMeasure(kind)
+    correlation_measure = ConnectivityMeasure(kind=kind)
     correlation_matrix = correlation_measure.fit_transform([time_series])[0]
 
     return correlation_matrix
 
 
-def to_power_fc_matrix(fc_vector):
+def generate_power_fc_matrices(
+        subject_files, output_folder=POWER_FC, cache_folder=POWER_FC_CACHE,
+        kind='correlation', smoothing_fwhm=6, radius=5., n_jobs=-1):
+    """
+    Generates the Power functional connectivity matrices for many subjects in
+    parallel, skipping subjects that have already been generated.
+
+    Each subject's matrix is cached under a key derived from the hash of its
+    input files and the masker parameters, so re-running after adding new
+    subjects (or with unchanged parameters) only processes the new subjects.
+    The matrices are then written to <output_folder>/<subject>/power_fc.npy,
+    the layout read by get_fc_data() and build_fc_store().
+
+    Parameters
+    ----------
+    subject_files : dict
+        Mapping of each subject's folder name (E.g. 'sub-NDARAA075AMK') to
+        their scan, either a 4D nifti or a list of 3D niftis.
+    output_folder : str, optional
+    cache_folder : str, optional
+    kind : str, optional
+    smoothing_fwhm : float, optional
+    radius : float, optional
+    n_jobs : int, optional
+        Number of processes, -1 means all processors.
+
+    Returns
+    -------
+    dict
+        Mapping of each subject's folder name to the path of their matrix.
+        Load with np.load().
+
+    Examples
+    --------
+    >>> subject_files = {
+    ...     subject: sorted(glob.glob(join(input_path, subject, 'ResI*')))
+    ...     for subject in subjects}
+    >>> fc_paths = generate_power_fc_matrices(
+    ...     subject_files, join(POWER_FC, 'Healthy'))
+
+    """
+    from joblib import Parallel, delayed
+
+    os.makedirs(cache_folder, exist_ok=True)
+    masker_params = {
+        'kind': kind, 'smoothing_fwhm': smoothing_fwhm, 'radius': radius}
+
+    subjects = list(subject_files)
+    cache_paths = Parallel(n_jobs=n_jobs)(
+        delayed(_generate_cached_power_fc_matrix)(
+            subject_files[subject], cache_folder, masker_params)
+        for subject in subjects)
+
+    return {subject: _publish_power_fc_matrix(
+                cache_path, os.path.join(output_folder, subject))
+            for subject, cache_path in zip(subjects, cache_paths)}
+
+
+def _publish_power_fc_matrix(cache_path, subject_folder):
+    """
+    Copies a cached matrix to the subject's power_fc.npy file.
+
+    Helper function for generate_power_fc_matrices().
+
+    Parameters
+    ----------
+    cache_path : str
+    subject_folder : str
+
+    Returns
+    -------
+    str
+        The path to the subject's power_fc.npy file.
+
+    """
+    os.makedirs(subject_folder, exist_ok=True)
+    output_path = os.path.join(subject_folder, 'power_fc.npy')
+
+    # Copy under a temporary name so readers never see a partial file
+    tmp_path = f'{output_path}.{os.getpid()}.tmp'
+    shutil.copyfile(cache_path, tmp_path)
+    os.replace(tmp_path, output_path)
+
+    return output_path
+
+
+def _generate_cached_power_fc_matrix(file, cache_folder, masker_params):
+    """
+    Generates one subject's Power functional connectivity matrix unless it's
+    already in the cache.
+
+    Helper function for generate_power_fc_matrices().
+
+    Parameters
+    ----------
+    file : str or list
+    cache_folder : str
+    masker_params : dict
+
+    Returns
+    -------
+    cache_path : str
+
+    """
+    cache_key = get_power_fc_cache_key(file, masker_params)
+    cache_path = os.path.join(cache_folder, f'{cache_key}.npy')
+
+    if os.path.exists(cache_path):
+        return cache_path
+
+    correlation_matrix = generate_power_fc_matrix(file, **masker_params)
+
+    # Write under a temporary name so a killed worker never leaves a partial
+    # file that looks cached
+    tmp_path = os.path.join(cache_folder, f'{cache_key}.{os.getpid()}.tmp.npy')
+    np.save(tmp_path, correlation_matrix)
+    os.replace(tmp_path, cache_path)
+
+    return cache_path
+
+
+def get_power_fc_cache_key(file, masker_params):
+    """
+    Gets the content-addressed cache key for a subject's functional
+    connectivity matrix.
+
+    The key is the SHA-256 hash of the subject's input files (in order) and
+    the masker parameters, so it changes if either the data or the parameters
+    change.
+
+    Parameters
+    ----------
+    file : str or list
+    masker_params : dict
+
+    Returns
+    -------
+    str
+
+    """
+    files = [file] if isinstance(file, str) else file
+    file_hash = hashlib.sha256()
+
+    for path in files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                file_hash.update(chunk)
+
+    file_hash.update(json.dumps(masker_params, sort_keys=True).encode())
+
+    return file_hash.hexdigest()
+
+
+def get_network_connection_mask(networks, mode='touching'):
+    """
+    Gets a boolean mask (34716 x 1) selecting the connections of one or more
+    Power networks.
+
+    Masks are cached, so repeated selections (E.g. across targets and bins)
+    are free. The returned mask is shared and read-only.
+
+    Parameters
+    ----------
+    networks : str or list
+        One or more network names (E.g. 'Default mode') or abbreviations
+        (E.g. 'DMN').
+    mode : str, optional
+        'touching' selects connections with at least one endpoint in any of
+        the networks, 'within' selects connections with both endpoints in the
+        same network (for any of the networks), and 'between' selects
+        connections with one endpoint in each of exactly two networks.
+
+    Returns
+    -------
+    np.array
+
+    """
+    networks = (networks,) if isinstance(networks, str) else tuple(networks)
+
+    return _get_network_connection_mask(networks, mode)
+
+
+def get_network_connection_indices(networks, mode='touching'):
+    """
+    Gets the indices of the connections of one or more Power networks.
+
+    Same as get_network_connection_mask() but returns the (cached, read-only)
+    indices of the selected connections.
+
+    Parameters
+    ----------
+    networks : str or list
+    mode : str, optional
+
+    Returns
+    -------
+    np.array
+
+    """
+    networks = (networks,) if isinstance(networks, str) else tuple(networks)
+
+    return _get_network_connection_indices(networks, mode)
+
+
+@lru_cache(maxsize=None)
+def _get_network_connection_mask(networks, mode):
+    """
+    Helper function for get_network_connection_mask() that caches the mask
+    for a normalized (tuple) network selection.
+
+    Parameters
+    ----------
+    networks : tuple
+    mode : str
+
+    Returns
+    -------
+    np.array
+
+    """
+    index = get_power_atlas_index()
+    codes = [index.get_network_code(network) for network in networks]
+
+    if mode == 'touching':
+        mask = np.any(index.network_masks[codes], axis=0)
+    elif mode == 'within':
+        mask = np.any(index.within_network_masks[codes], axis=0)
+    elif mode == 'between':
+        if len(codes) != 2:
+            raise ValueError('Between mode requires exactly two networks')
+        mask = ((index.edge_net_a == codes[0]) & (index.edge_net_b == codes[1]) |
+                (index.edge_net_a == codes[1]) & (index.edge_net_b == codes[0]))
+    else:
+        raise ValueError(f'Unknown network selection mode: {mode}')
+
+    mask.setflags(write=False)
+
+    return mask
+
+
+@lru_cache(maxsize=None)
+def _get_network_connection_indices(networks, mode):
+    """
+    Helper function for get_network_connection_indices() that caches the
+    indices for a normalized (tuple) network selection.
+
+    Parameters
+    ----------
+    networks : tuple
+    mode : str
+
+    Returns
+    -------
+    np.array
+
+    """
+    indices = np.flatnonzero(_get_network_connection_mask(networks, mode))
+    indices.setflags(write=False)
+
+    return indices
+
+
+def to_power_fc_matrix(fc_vector, dtype=None):
     """
     Converts a Power connectivity vector (34716 x 1) to a matrix (264 x 264).
 
@@ -89,13 +422,18 @@ def to_power_fc_matrix(fc_vector):
     Parameters
     ----------
     fc_vector : np.array
+    dtype : np.dtype, optional
+        The matrix's dtype, defaults to the vector's floating point dtype.
 
     Returns
     -------
     fc_matrix : np.array
 
     """
-    fc_matrix = np.zeros((POWER_NUM_NODES, POWER_NUM_NODES))
+    if dtype is None:
+        dtype = np.result_type(np.asarray(fc_vector).dtype, np.float32)
+
+    fc_matrix = np.zeros((POWER_NUM_NODES, POWER_NUM_NODES), dtype=dtype)
     fc_matrix[np.triu_indices_from(fc_matrix, k=1)] = fc_vector
     fc_matrix = fc_matrix + fc_matrix.T
 
@@ -137,7 +475,8 @@ def get_power_fc_matrix_labels(return_system=True):
     np.array
 
     """
-    labels = POWER_LABELS['System'].values if return_system else POWER_LABELS.index
+    power_labels = get_power_labels()
+    labels = power_labels['System'].values if return_system else power_labels.index
 
     label_matrix = []
 
@@ -166,12 +505,112 @@ def get_power_fc_vector_labels(return_system=True):
     np.array
 
     """
-    power_fc_matrix_labels = get_power_fc_matrix_labels(return_system)
-    power_fc_vector_labels = to_power_fc_vector(power_fc_matrix_labels)
+    power_labels = get_power_labels()
+    labels = power_labels['System'] if return_system else power_labels.index
+    labels = np.array(labels.tolist())
+
+    rows, cols = np.triu_indices(POWER_NUM_NODES, k=1)
+    power_fc_vector_labels = np.stack((labels[rows], labels[cols]), axis=1)
 
     return power_fc_vector_labels
 
 
+class PowerAtlasIndex:
+    """
+    Class containing integer lookup tables mapping each connection in a Power
+    FC vector (34716 x 1) to its networks.
+
+    Used to replace loops over the string labels from
+    get_power_fc_vector_labels() with vectorized lookups. Networks are coded
+    by their position in POWER_NETWORKS and network pairs are coded by their
+    position in the upper triangle (including the diagonal) of a 13 x 13
+    network matrix, which is the order used by to_power_network_fc_matrix().
+    Get the shared instance with get_power_atlas_index().
+    """
+    def __init__(self, node_systems):
+        """
+        Initializes the lookup tables from the system/network of each ROI.
+
+        Parameters
+        ----------
+        node_systems : list
+            The system/network name of each of the 264 ROIs.
+
+        """
+        self.networks = tuple(POWER_NETWORKS.values())
+        network_codes = {network: code for code, network in
+                         enumerate(self.networks)}
+
+        # Network code of each node and of both endpoints of each connection
+        self.node_net = np.array(
+            [network_codes[system] for system in node_systems], dtype=np.int8)
+        rows, cols = np.triu_indices(POWER_NUM_NODES, k=1)
+        self.edge_net_a = self.node_net[rows]
+        self.edge_net_b = self.node_net[cols]
+
+        # Network pair ID (0 to 90) of each connection, order doesn't matter
+        pair_rows, pair_cols = np.triu_indices(POWER_NUM_NETWORKS, k=0)
+        self.pair_networks = np.stack((pair_rows, pair_cols),
+                                      axis=1).astype(np.int8)
+        pair_lookup = np.zeros((POWER_NUM_NETWORKS, POWER_NUM_NETWORKS),
+                               dtype=np.int16)
+        pair_lookup[pair_rows, pair_cols] = np.arange(len(pair_rows))
+        pair_lookup[pair_cols, pair_rows] = np.arange(len(pair_rows))
+        self.edge_pair_id = pair_lookup[self.edge_net_a, self.edge_net_b]
+        self.pair_counts = np.bincount(self.edge_pair_id,
+                                       minlength=len(pair_rows))
+
+        # Connection order that groups connections by network pair, and where
+        # each pair's group starts, for grouped reductions (np.ufunc.reduceat)
+        self.pair_edge_order = np.argsort(self.edge_pair_id, kind='stable')
+        self.pair_starts = np.concatenate(
+            ([0], np.cumsum(self.pair_counts)[:-1]))
+
+        # Per-network masks (13 x 34716) of connections touching or within it
+        network_range = np.arange(POWER_NUM_NETWORKS)[:, np.newaxis]
+        is_a = self.edge_net_a == network_range
+        is_b = self.edge_net_b == network_range
+        self.network_masks = is_a | is_b
+        self.within_network_masks = is_a & is_b
+
+        # The instance is shared, so protect the tables from accidental writes
+        for table in (self.node_net, self.edge_net_a, self.edge_net_b,
+                      self.pair_networks, self.edge_pair_id, self.pair_counts,
+                      self.pair_edge_order, self.pair_starts,
+                      self.network_masks, self.within_network_masks):
+            table.setflags(write=False)
+
+    def get_network_code(self, network):
+        """
+        Gets the integer code of a network.
+
+        Parameters
+        ----------
+        network : str
+            The network's full name (E.g. 'Default mode') or abbreviation
+            (E.g. 'DMN').
+
+        Returns
+        -------
+        int
+
+        """
+        return self.networks.index(POWER_NETWORKS.get(network, network))
+
+
+@lru_cache(maxsize=None)
+def get_power_atlas_index():
+    """
+    Gets the shared Power atlas index, computing it on the first call.
+
+    Returns
+    -------
+    PowerAtlasIndex
+
+    """
+    return PowerAtlasIndex(get_power_labels()['System'].tolist())
+
+
 def get_power_mpl_legend():
     """
     Gets the Power legend as a list of Matplotlib legend patches mapping color
@@ -182,6 +621,8 @@ def get_power_mpl_legend():
     power_legend_patches : list
 
     """
+    import matplotlib.patches as mpatches
+
     power_legend_patches = []
 
     for color, system in POWER_LEGEND.items():
@@ -198,37 +639,80 @@ def to_power_network_fc_vector(fc_node_vector, reduction_func=np.mean):
     Can reduce the vector by various functions (mean, sum,
     sum of absolute value, etc.)
 
+    The network pairs are ordered like the upper triangle (including the
+    diagonal) of to_power_network_fc_matrix(), with networks in the order of
+    POWER_NETWORKS (I.e. VIS-VIS, VIS-FPN, ..., VIS-DAN, FPN-FPN, ...).
+
     Parameters
     ----------
     fc_node_vector : np.array
-    reduction_func : function, optional.
+    reduction_func : function or str, optional.
+        Any function reducing a list of weights to one value, or one of the
+        reductions supported by to_power_network_fc_vectors(). np.mean,
+        np.sum, and np.max use the vectorized reductions.
 
     Returns
     -------
     np.array
 
     """
-    # Get all connections for each network pair
-    network_weights = dict()
-    vector_labels = get_power_fc_vector_labels()
+    reduction = _NETWORK_REDUCTION_FUNCS.get(reduction_func, reduction_func)
 
-    for endpoint, weight in zip(vector_labels, fc_node_vector):
-        # Use frozenset because order of network pair doesn't matter
-        endpoint = frozenset(endpoint)
+    if isinstance(reduction, str):
+        return to_power_network_fc_vectors(fc_node_vector, reduction)
 
-        if endpoint not in network_weights:
-            network_weights[endpoint] = [weight]
-        else:
-            network_weights[endpoint].append(weight)
+    # Group the connections by network pair and reduce each group
+    index = get_power_atlas_index()
+    grouped_weights = np.asarray(fc_node_vector)[index.pair_edge_order]
+    network_weights = np.split(grouped_weights, index.pair_starts[1:])
 
-    # Reduce the connections for each network pair
-    network_reduced_weights = dict()
-    for network, weights in network_weights.items():
-        network_reduced_weights[network] = reduction_func(weights)
+    return np.array([reduction(weights) for weights in network_weights])
 
-    fc_network_vector = list(network_reduced_weights.values())
 
-    return fc_network_vector
+def to_power_network_fc_vectors(fc_node_vectors, reduction='mean'):
+    """
+    Reduces a batch of Power FC vectors (n_samples x 34716) to Power FC network
+    vectors (n_samples x 91).
+
+    Uses grouped reductions over connections sorted by network pair, so the
+    whole batch is reduced at once. The network pairs are in the same order
+    as to_power_network_fc_vector().
+
+    Parameters
+    ----------
+    fc_node_vectors : np.array
+        A batch of vectors, or a single vector (34716 x 1).
+    reduction : str, optional
+        One of 'mean', 'sum', 'abs_sum' (sum of absolute values), or 'max'.
+
+    Returns
+    -------
+    np.array
+        The network vectors, with the same number of dimensions as the input.
+
+    """
+    index = get_power_atlas_index()
+    fc_node_vectors = np.asarray(fc_node_vectors)
+    grouped_weights = np.atleast_2d(fc_node_vectors)[:, index.pair_edge_order]
+
+    if reduction == 'abs_sum':
+        grouped_weights = np.abs(grouped_weights)
+
+    if reduction in ('mean', 'sum', 'abs_sum'):
+        fc_network_vectors = np.add.reduceat(
+            grouped_weights, index.pair_starts, axis=1)
+        if reduction == 'mean':
+            fc_network_vectors = fc_network_vectors / index.pair_counts
+    elif reduction == 'max':
+        fc_network_vectors = np.maximum.reduceat(
+            grouped_weights, index.pair_starts, axis=1)
+    else:
+        raise ValueError(f'Unknown network reduction: {reduction}')
+
+    if fc_node_vectors.ndim == 1:
+        return fc_network_vectors[0]
+
+    return fc_network_vectors
 
 
 def to_power_network_fc_matrix(fc_network_vector):
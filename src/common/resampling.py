@@ -0,0 +1,176 @@
+"""
+Holds the functions for repeated random subsampling (E.g. equal sample size
+analyses), with every subsample drawn up front from one seeded generator so
+the repeats are reproducible and can be split between parallel workers.
+"""
+import numpy as np
+from joblib import Parallel, delayed
+
+from common.scoring import get_n_chunks
+
+
+def get_subsample_indices(n_samples, num_samples, n_repeats=1,
+                          random_state=None):
+    """
+    Draws random subsamples (without replacement) for many repeats at once.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of samples to draw from.
+    num_samples : int
+        Number of samples in each subsample.
+    n_repeats : int, optional
+    random_state : int or np.random.Generator, optional
+
+    Returns
+    -------
+    np.array
+        The indices of each repeat's subsample (repeats x num_samples).
+
+    Examples
+    --------
+    >>> get_subsample_indices(147, 113, n_repeats=500, random_state=0).shape
+    (500, 113)
+
+    """
+    if num_samples > n_samples:
+        raise ValueError(f'Cannot draw {num_samples} samples from {n_samples} '
+                         f'without replacement')
+
+    rng = np.random.default_rng(random_state)
+
+    # Each row is an independent permutation, keep the first num_samples
+    return rng.permuted(np.tile(np.arange(n_samples), (n_repeats, 1)),
+                        axis=1)[:, :num_samples]
+
+
+def get_equal_size_bin_indices(n_samples, bin_sizes, n_repeats=1,
+                               random_state=None):
+    """
+    Randomly splits the samples into bins of the given sizes, disregarding
+    age, for many repeats at once.
+
+    Parameters
+    ----------
+    n_samples : int
+    bin_sizes : list
+        Number of samples in each bin, the bins don't overlap.
+    n_repeats : int, optional
+    random_state : int or np.random.Generator, optional
+
+    Returns
+    -------
+    list
+        The indices of each bin (repeats x bin size).
+
+    """
+    bin_ends = np.cumsum(bin_sizes)
+    subsamples = get_subsample_indices(n_samples, bin_ends[-1], n_repeats,
+                                       random_state)
+
+    return np.split(subsamples, bin_ends[:-1], axis=1)
+
+
+def repeated_subsample_scores(score_func, X, y, num_samples, n_repeats=100,
+                              indices=None, random_state=None, n_jobs=None):
+    """
+    Scores many random subsamples of the data in parallel.
+
+    The subsamples are drawn before any work is split between the workers,
+    so the results only depend on random_state and not on n_jobs.
+
+    Parameters
+    ----------
+    score_func : callable
+        Called as score_func(X_subsample, y_subsample) and returns a score
+        (float or np.array). Must be picklable (E.g. a module-level function
+        or functools.partial) when n_jobs isn't 1.
+    X : np.array
+    y : np.array
+    num_samples : int
+        Number of samples in each subsample.
+    n_repeats : int, optional
+    indices : np.array, optional
+        The samples to draw from (E.g. AgeBin.indices), defaults to all
+        samples.
+    random_state : int or np.random.Generator, optional
+    n_jobs : int, optional
+
+    Returns
+    -------
+    np.array
+        The score of each repeat (repeats x score shape).
+
+    Examples
+    --------
+    >>> def score_ridge(X, y):
+    ...     return np.mean(cross_val_score(pipe, X, y, cv=RKF_10_10,
+    ...                                    scoring=unimetric_scorer))
+    >>> scores = repeated_subsample_scores(
+    ...     score_ridge, X, y, 113, 500, age_bins[2].indices, random_state=0,
+    ...     n_jobs=-1)
+    >>> aggregate_repeat_scores(scores)
+
+    """
+    indices = np.arange(len(X)) if indices is None else np.asarray(indices)
+    subsamples = indices[get_subsample_indices(len(indices), num_samples,
+                                               n_repeats, random_state)]
+
+    subsample_chunks = np.array_split(subsamples,
+                                      get_n_chunks(n_repeats, n_jobs))
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(_score_subsamples)(score_func, X, y, subsample_chunk)
+        for subsample_chunk in subsample_chunks)
+
+    return np.concatenate(scores, axis=0)
+
+
+def aggregate_repeat_scores(scores, alpha=0.05):
+    """
+    Summarizes the scores of repeated subsamples.
+
+    Parameters
+    ----------
+    scores : np.array
+        The score of each repeat (repeats x score shape).
+    alpha : float, optional
+        Significance level of the percentile interval.
+
+    Returns
+    -------
+    dict
+        Mapping of 'mean', 'std', and 'interval' (lower and upper percentile
+        in the last dimension) to the summary across repeats.
+
+    """
+    return {
+        'mean': np.nanmean(scores, axis=0),
+        'std': np.nanstd(scores, axis=0),
+        'interval': np.moveaxis(np.nanquantile(
+            scores, [alpha / 2, 1 - alpha / 2], axis=0), 0, -1),
+    }
+
+
+def _score_subsamples(score_func, X, y, subsamples):
+    """
+    Scores a chunk of subsamples.
+
+    Helper function for repeated_subsample_scores().
+
+    Parameters
+    ----------
+    score_func : callable
+    X : np.array
+    y : np.array
+    subsamples : np.array
+        The indices of each subsample (repeats x num_samples).
+
+    Returns
+    -------
+    np.array
+        The score of each subsample.
+
+    """
+    return np.array([score_func(X[subsample], y[subsample])
+                     for subsample in subsamples])
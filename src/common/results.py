@@ -1,11 +1,25 @@
 """
 Holds the functions for saving and loading the model's results and permutation test results.
 """
+import glob
+import json
+import os
+import sqlite3
 from os.path import join, exists
 
 import numpy as np
 import pandas as pd
 
+from common.paths import MODEL_RESULTS_DB
+from common.scoring import get_permutation_seeds
+
+PERM_CHECKPOINT_MANIFEST = 'checkpoint.json'
+
+# Columns (from CVResult.to_dict()) that identify a result in the results
+# database, saving a result with the same key replaces the old one
+RESULT_KEY_COLUMNS = [
+    'Model', 'Target', 'Train', 'Test', 'Population', 'Num Permutations']
+
 
 class Result:
     """
@@ -14,6 +28,8 @@ class Result:
     Used to keep the reporting of results consistent across models and
     methodologies.
     """
+    __slots__ = ('model', 'target', 'train', 'test', 'score', 'pvalue')
+
     def __init__(self, model, target, train, test, score, pvalue):
         """
         Initializes the class with a set of results.
@@ -61,6 +77,8 @@ class CVResult(Result):
     Used to keep the reporting of results consistent across models and
     methodologies.
     """
+    __slots__ = ('population', 'n_permutations')
+
     def __init__(
             self, model, target, train, test, score, pvalue, population,
             n_permutations):
@@ -77,6 +95,8 @@ class CVResult(Result):
         pvalue : float
         population : str
         n_permutations : int
+            The number of permutations the p-value is based on, which can be
+            less than requested for sequential permutation tests.
 
         """
         super().__init__(model, target, train, test, score, pvalue)
@@ -115,6 +135,308 @@ class CVResult(Result):
         return result
 
 
+class ResultTable:
+    """
+    Class containing many cross-validation results stored column-wise.
+
+    Used instead of a list of CVResult when logging per-fold or
+    per-permutation results, where one object per result uses too much
+    memory. Text columns are stored as integer codes into a list of unique
+    values, and numeric columns as NumPy arrays. Indexing or iterating gives
+    ResultRow views with the same attributes and to_dict() as CVResult.
+    """
+    # Attribute, CVResult.to_dict() column, and dtype (None for text columns)
+    COLUMNS = (
+        ('model', 'Model', None),
+        ('target', 'Target', None),
+        ('train', 'Train', None),
+        ('test', 'Test', None),
+        ('score', 'Score', np.float64),
+        ('pvalue', 'P-value', np.float64),
+        ('population', 'Population', None),
+        ('n_permutations', 'Num Permutations', np.int64),
+    )
+
+    def __init__(self, capacity=1024):
+        """
+        Initializes an empty table.
+
+        Parameters
+        ----------
+        capacity : int, optional
+            Number of rows to allocate up front, grows as needed.
+
+        """
+        self._size = 0
+        self._arrays = {}
+        self._categories = {}
+        self._category_values = {}
+
+        for attribute, _, dtype in self.COLUMNS:
+            self._arrays[attribute] = np.empty(
+                capacity, dtype=np.int32 if dtype is None else dtype)
+            if dtype is None:
+                self._categories[attribute] = {}
+                self._category_values[attribute] = []
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, row):
+        if not -self._size <= row < self._size:
+            raise IndexError('ResultTable index out of range')
+
+        return ResultRow(self, row % self._size)
+
+    def __iter__(self):
+        return (ResultRow(self, row) for row in range(self._size))
+
+    def append(self, result):
+        """
+        Appends one result.
+
+        Parameters
+        ----------
+        result : CVResult or ResultRow
+
+        Returns
+        -------
+        None
+
+        """
+        self.extend(**{attribute: getattr(result, attribute)
+                       for attribute, _, _ in self.COLUMNS})
+
+    def extend(self, model, target, train, test, score, pvalue, population,
+               n_permutations):
+        """
+        Appends a batch of results, where each argument is either one value
+        for every result or an array with one value per result. Nothing is
+        appended if any of the arrays is empty.
+
+        Parameters
+        ----------
+        model : str or np.array
+        target : str or np.array
+        train : str or np.array
+        test : str or np.array
+        score : float or np.array
+        pvalue : float or np.array
+        population : str or np.array
+        n_permutations : int or np.array
+
+        Returns
+        -------
+        None
+
+        Examples
+        --------
+        >>> table.extend('ridge', target, 'Bin 1', 'Bin 1', perm_scores,
+        ...              np.nan, population, N_PERM)
+
+        """
+        values = {'model': model, 'target': target, 'train': train,
+                  'test': test, 'score': score, 'pvalue': pvalue,
+                  'population': population, 'n_permutations': n_permutations}
+        sizes = [np.size(value) for value in values.values()
+                 if not isinstance(value, str) and np.ndim(value) > 0]
+        n_rows = max(sizes, default=1)
+        if min(sizes, default=1) == 0:
+            return
+
+        self._reserve(self._size + n_rows)
+        rows = slice(self._size, self._size + n_rows)
+
+        for attribute, _, dtype in self.COLUMNS:
+            value = values[attribute]
+            if dtype is None:
+                value = self._encode(attribute, value)
+            self._arrays[attribute][rows] = value
+
+        self._size += n_rows
+
+    def to_dataframe(self):
+        """
+        Converts the table into a dataframe with the same columns as
+        CVResult.to_dict().
+
+        Text columns become categoricals built directly from the stored codes,
+        so no per-row Python objects are created.
+
+        Returns
+        -------
+        pd.DataFrame
+
+        """
+        columns = {}
+
+        for attribute, column, dtype in self.COLUMNS:
+            values = self._arrays[attribute][:self._size]
+            if dtype is None:
+                values = pd.Categorical.from_codes(
+                    values, categories=self._category_values[attribute])
+            columns[column] = values
+
+        return pd.DataFrame(columns, copy=False)
+
+    def get_value(self, attribute, row):
+        """
+        Gets one value of the table.
+
+        Parameters
+        ----------
+        attribute : str
+        row : int
+
+        Returns
+        -------
+        object
+
+        """
+        value = self._arrays[attribute][row]
+
+        if attribute in self._categories:
+            return self._category_values[attribute][value]
+
+        return value.item()
+
+    def _encode(self, attribute, values):
+        """
+        Converts text values into their integer codes, adding new values.
+
+        Parameters
+        ----------
+        attribute : str
+        values : str or np.array
+
+        Returns
+        -------
+        int or np.array
+
+        """
+        if isinstance(values, str):
+            return self._encode_value(attribute, values)
+
+        unique_values, inverse = np.unique(np.asarray(values),
+                                           return_inverse=True)
+        codes = np.array([self._encode_value(attribute, value)
+                          for value in unique_values.tolist()], dtype=np.int32)
+
+        return codes[inverse]
+
+    def _encode_value(self, attribute, value):
+        """
+        Gets the integer code of one text value, adding it if it's new.
+
+        Parameters
+        ----------
+        attribute : str
+        value : str
+
+        Returns
+        -------
+        int
+
+        """
+        categories = self._categories[attribute]
+
+        if value not in categories:
+            categories[value] = len(categories)
+            self._category_values[attribute].append(value)
+
+        return categories[value]
+
+    def _reserve(self, n_rows):
+        """
+        Grows the arrays (doubling their size) to fit at least n_rows.
+
+        Parameters
+        ----------
+        n_rows : int
+
+        Returns
+        -------
+        None
+
+        """
+        capacity = len(self._arrays['score'])
+        if n_rows <= capacity:
+            return
+
+        capacity = max(n_rows, 2 * capacity)
+        for attribute, array in self._arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            self._arrays[attribute] = grown
+
+
+class ResultRow:
+    """
+    Class containing a view of one row of a ResultTable.
+
+    Has the same attributes and methods as CVResult, so code written for
+    CVResult works with rows of a ResultTable. Pickling a row (E.g. to send
+    it to a joblib worker) pickles its table along with it.
+
+    Examples
+    --------
+    >>> row = pickle.loads(pickle.dumps(table[0]))
+    >>> row.to_string() == table[0].to_string()
+    True
+    """
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        """
+        Initializes the view.
+
+        Parameters
+        ----------
+        table : ResultTable
+        row : int
+
+        """
+        self._table = table
+        self._row = row
+
+    def __getattr__(self, attribute):
+        # Private names are never columns, and the slots aren't set yet while
+        # a copy or unpickled row is being built
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+
+        if attribute in self._table._arrays:
+            return self._table.get_value(attribute, self._row)
+
+        raise AttributeError(attribute)
+
+    def __reduce__(self):
+        return ResultRow, (self._table, self._row)
+
+    def to_dict(self):
+        """
+        Converts the row into a dictionary.
+
+        Returns
+        -------
+        dict
+
+        """
+        return {column: getattr(self, attribute)
+                for attribute, column, _ in ResultTable.COLUMNS}
+
+    def to_string(self):
+        """
+        Converts the row into a string.
+
+        Returns
+        -------
+        str
+
+        """
+        return CVResult.to_string(self)
+
+
 def save_results(results, fn, output_folder, append=False):
     """
     Saves the results to a csv file.
@@ -167,6 +489,173 @@ def load_results(fn, input_folder):
     return results, input_path
 
 
+def save_results_db(results, db_path=MODEL_RESULTS_DB):
+    """
+    Saves the results to a SQLite database, replacing any results with the
+    same key (see RESULT_KEY_COLUMNS).
+
+    Unlike appending to a csv file, writes are atomic so many workers can
+    save to the same database at once, and re-running a model updates its
+    results instead of adding duplicates. Columns other than the key columns
+    (E.g. 'Alpha') are added to the database as needed.
+
+    Parameters
+    ----------
+    results : pd.DataFrame
+        Results with at least the key columns, E.g. from CVResult.to_dict().
+    db_path : str, optional
+
+    Returns
+    -------
+    db_path : str
+
+    """
+    columns = list(results.columns)
+    missing_keys = set(RESULT_KEY_COLUMNS) - set(columns)
+    if missing_keys:
+        raise ValueError(f'Results are missing key columns: {sorted(missing_keys)}')
+
+    quoted = [_quote_column(column) for column in columns]
+    updates = [f'{column} = excluded.{column}' for column, name in
+               zip(quoted, columns) if name not in RESULT_KEY_COLUMNS]
+    conflict = 'DO UPDATE SET ' + ', '.join(updates) if updates else 'DO NOTHING'
+    rows = [tuple(_to_sql_value(value) for value in row)
+            for row in results.itertuples(index=False, name=None)]
+
+    with _connect_results_db(db_path) as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        existing = {row[1] for row in connection.execute('PRAGMA table_info(results)')}
+        for column, name in zip(quoted, columns):
+            if name not in existing:
+                connection.execute(f'ALTER TABLE results ADD COLUMN {column}')
+
+        connection.executemany(
+            f'INSERT INTO results ({", ".join(quoted)}) '
+            f'VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT ({", ".join(map(_quote_column, RESULT_KEY_COLUMNS))}) '
+            f'{conflict}', rows)
+
+    return db_path
+
+
+def load_results_db(filters=None, db_path=MODEL_RESULTS_DB):
+    """
+    Loads the results matching the given filters from a SQLite database.
+
+    Filtering is done by the database, so only the matching results are read.
+
+    Parameters
+    ----------
+    filters : dict, optional
+        Mapping of column to the wanted value or list of values.
+    db_path : str, optional
+
+    Returns
+    -------
+    results : pd.DataFrame
+
+    Examples
+    --------
+    >>> load_results_db({'Model': 'ridge', 'Population': 'adhd',
+    ...                  'Target': ['WISC_FSIQ', 'WISC_VCI']})
+
+    """
+    conditions, params = [], []
+
+    for column, value in (filters or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        conditions.append(
+            f'{_quote_column(column)} IN ({", ".join("?" * len(values))})')
+        params.extend(_to_sql_value(v) for v in values)
+
+    query = 'SELECT * FROM results'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    with _connect_results_db(db_path) as connection:
+        results = pd.read_sql_query(query, connection, params=params)
+
+    return results
+
+
+def _connect_results_db(db_path):
+    """
+    Connects to the results database, creating the results table if needed.
+
+    Helper function for save_results_db() and load_results_db().
+
+    Parameters
+    ----------
+    db_path : str
+
+    Returns
+    -------
+    _ResultsDBConnection
+        Closes the connection when the with block exits.
+
+    """
+    # Autocommit mode, transactions are started explicitly. The default
+    # rollback journal is kept since WAL needs shared memory, which doesn't
+    # work across hosts on the network file system of the scratch folder
+    connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+
+    key_columns = ', '.join(map(_quote_column, RESULT_KEY_COLUMNS))
+    connection.execute(
+        f'CREATE TABLE IF NOT EXISTS results ({key_columns}, '
+        f'PRIMARY KEY ({key_columns}))')
+
+    return _ResultsDBConnection(connection)
+
+
+class _ResultsDBConnection:
+    """
+    Context manager that commits (or rolls back) any open transaction on exit
+    and closes the results database connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.connection.in_transaction:
+            self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        self.connection.close()
+
+
+def _quote_column(column):
+    """
+    Quotes a column name for SQLite (E.g. 'P-value' -> '"P-value"').
+
+    Parameters
+    ----------
+    column : str
+
+    Returns
+    -------
+    str
+
+    """
+    return '"' + str(column).replace('"', '""') + '"'
+
+
+def _to_sql_value(value):
+    """
+    Converts NumPy scalars into Python values that SQLite can store.
+
+    Parameters
+    ----------
+    value : object
+
+    Returns
+    -------
+    object
+
+    """
+    return value.item() if isinstance(value, np.generic) else value
+
+
 def save_perm_score(perm_scores, fn, output_folder):
     """
     Saves the permutation scores to a NumPy array file.
@@ -210,3 +699,155 @@ def load_perm_score(fn, input_folder):
     perm_scores = np.load(input_path)
 
     return perm_scores
+
+
+def get_perm_checkpoint_folder(model, population, target, bin_label,
+                               output_folder):
+    """
+    Gets the folder of a checkpointed permutation run for a specific model,
+    diagnosis, WISC measure, and age bin.
+
+    Parameters
+    ----------
+    model : str
+    population : str
+    target : str
+    bin_label : str
+    output_folder : str
+
+    Returns
+    -------
+    str
+
+    """
+    return join(output_folder, f'{model}_{population}_{target}_{bin_label}_perm_scores')
+
+
+def run_checkpointed_permutations(
+        score_permutations, n_permutations, checkpoint_folder, chunk_size=50,
+        random_state=None):
+    """
+    Runs a permutation test in chunks, saving each chunk's permutation scores
+    as soon as it's done and resuming from the saved chunks when restarted.
+
+    Permutations are identified by their seed from get_permutation_seeds(),
+    so a resumed or extended run (E.g. topping up 500 permutations to 5000)
+    gives the same permutation scores as one uninterrupted run. The random
+    state is saved with the checkpoint so resuming doesn't need it again.
+
+    Parameters
+    ----------
+    score_permutations : function
+        Scores the permutations for a list of seeds, returning an array with
+        permutations on the last axis (E.g.
+        cross_prediction_permutation_scores() with the other arguments bound).
+    n_permutations : int
+        The total number of permutations wanted, including saved ones.
+    checkpoint_folder : str
+        See get_perm_checkpoint_folder().
+    chunk_size : int, optional
+    random_state : int, optional
+
+    Returns
+    -------
+    perm_scores : np.array
+        The first n_permutations permutation scores.
+
+    Examples
+    --------
+    >>> folder = get_perm_checkpoint_folder(
+    ...     'ridge', population, target, 'All', CROSS_PRED_PSCORES)
+    >>> perms = run_checkpointed_permutations(
+    ...     lambda seeds: cross_prediction_permutation_scores(
+    ...         pipe, bins, bins_cv, seeds, unimetric_scorer, n_jobs=-1),
+    ...     N_PERM, folder, random_state=0)
+
+    """
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    random_state = _load_perm_checkpoint_random_state(
+        checkpoint_folder, random_state)
+    perm_scores = load_perm_checkpoint(checkpoint_folder)
+    n_done = 0 if perm_scores is None else perm_scores.shape[-1]
+
+    for start in range(n_done, n_permutations, chunk_size):
+        n_chunk = min(chunk_size, n_permutations - start)
+        seeds = get_permutation_seeds(n_chunk, random_state, start)
+        chunk_scores = np.asarray(score_permutations(seeds))
+
+        # Write under a temporary name so a preempted job never leaves a
+        # partial chunk behind
+        chunk_path = join(checkpoint_folder, f'chunk_{start:07d}.npy')
+        tmp_path = join(checkpoint_folder,
+                        f'chunk_{start:07d}.{os.getpid()}.tmp.npy')
+        np.save(tmp_path, chunk_scores)
+        os.replace(tmp_path, chunk_path)
+
+    return load_perm_checkpoint(checkpoint_folder)[..., :n_permutations]
+
+
+def load_perm_checkpoint(checkpoint_folder):
+    """
+    Loads the permutation scores saved by run_checkpointed_permutations().
+
+    Parameters
+    ----------
+    checkpoint_folder : str
+
+    Returns
+    -------
+    perm_scores : np.array
+        The saved permutation scores, permutations on the last axis, or None
+        if no permutations have been saved.
+
+    """
+    chunk_paths = sorted(glob.glob(join(checkpoint_folder,
+                                        'chunk_*[0-9].npy')))
+
+    if not chunk_paths:
+        return None
+
+    return np.concatenate([np.load(path) for path in chunk_paths], axis=-1)
+
+
+def _load_perm_checkpoint_random_state(checkpoint_folder, random_state):
+    """
+    Loads the random state of a checkpointed permutation run, or saves it if
+    the run is new.
+
+    Helper function for run_checkpointed_permutations().
+
+    Parameters
+    ----------
+    checkpoint_folder : str
+    random_state : int
+        If None, the saved random state is used, or fresh entropy for a new
+        run.
+
+    Returns
+    -------
+    int
+
+    """
+    manifest_path = join(checkpoint_folder, PERM_CHECKPOINT_MANIFEST)
+
+    if exists(manifest_path):
+        with open(manifest_path) as f:
+            saved_random_state = json.load(f)['random_state']
+
+        if random_state is not None and random_state != saved_random_state:
+            raise ValueError(
+                f'Checkpoint random state {saved_random_state} does not match '
+                f'{random_state}: {checkpoint_folder}')
+
+        return saved_random_state
+
+    if random_state is None:
+        random_state = np.random.SeedSequence().entropy
+
+    # Same as the chunks, so a preempted job never leaves a partial manifest
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'random_state': random_state}, f)
+    os.replace(tmp_path, manifest_path)
+
+    return random_state
@@ -2,8 +2,8 @@
 Holds the functions for scoring the model.
 """
 import numpy as np
+from joblib import effective_n_jobs
 from scipy import stats
-from sklearn.metrics import mean_squared_error, r2_score
 from sklearn.model_selection import RepeatedKFold
 
 N_PERM = 500
@@ -32,11 +32,7 @@ def multimetric_scorer(model, X, y):
     if y_pred.ndim == 2:
         y_pred = np.squeeze(y_pred)
 
-    r, p_value = stats.pearsonr(y, y_pred)
-    mse = mean_squared_error(y, y_pred)
-    r2 = r2_score(y, y_pred)
-
-    return {'r': r, 'p_value': p_value, 'mse': mse, 'r2': r2}
+    return batch_scorer(y, y_pred, return_pvalue=True)
 
 
 def unimetric_scorer(model, X, y):
@@ -59,9 +55,149 @@ def unimetric_scorer(model, X, y):
     if y_pred.ndim == 2:
         y_pred = np.squeeze(y_pred)
 
-    r, p_value = stats.pearsonr(y, y_pred)
+    # Skip the p-value since it's thrown away
+    return batch_scorer(y, y_pred, metrics=('r',))['r']
+
+
+def batch_scorer(y_true, y_preds, metrics=('r', 'mse', 'r2'),
+                 return_pvalue=False):
+    """
+    Scores many sets of predictions at once using multiple metrics (Pearson r,
+    MSE, r2).
+
+    Each column of y_preds is one set of predictions (E.g. one permutation),
+    and all columns are scored in one vectorized pass instead of calling the
+    scipy/sklearn metrics once per column.
+
+    Parameters
+    ----------
+    y_true : np.array
+        Either the targets for all columns (n_samples) or one set of targets
+        per column (n_samples x n_columns), E.g. permuted targets.
+    y_preds : np.array
+        The predictions (n_samples) or (n_samples x n_columns).
+    metrics : tuple, optional
+        Any of 'r', 'mse', and 'r2'.
+    return_pvalue : bool, optional
+        Whether to also calculate the analytic (two-sided) p-value of the
+        Pearson r, same as scipy.stats.pearsonr().
+
+    Returns
+    -------
+    dict
+        Mapping of metric to scores, one per column. Scores are floats if
+        both inputs are one-dimensional.
+
+    """
+    y_true, y_preds = np.asarray(y_true), np.asarray(y_preds)
+    is_single = y_true.ndim == 1 and y_preds.ndim == 1
+
+    if y_true.ndim == 1:
+        y_true = y_true[:, np.newaxis]
+    if y_preds.ndim == 1:
+        y_preds = y_preds[:, np.newaxis]
+
+    scores = {}
+    n_samples = y_true.shape[0]
+    y_true_centered = y_true - y_true.mean(axis=0)
+    y_true_ss = np.sum(y_true_centered ** 2, axis=0)
+
+    if 'r' in metrics or return_pvalue:
+        y_preds_centered = y_preds - y_preds.mean(axis=0)
+        r = np.sum(y_true_centered * y_preds_centered, axis=0) / np.sqrt(
+            y_true_ss * np.sum(y_preds_centered ** 2, axis=0))
+        scores['r'] = np.clip(r, -1, 1)
+
+    if return_pvalue:
+        # Same t-test as scipy.stats.pearsonr()
+        dof = n_samples - 2
+        with np.errstate(divide='ignore'):
+            t = scores['r'] * np.sqrt(dof / (1 - scores['r'] ** 2))
+        scores['p_value'] = 2 * stats.t.sf(np.abs(t), dof)
+
+    if 'mse' in metrics or 'r2' in metrics:
+        residual_ss = np.sum((y_true - y_preds) ** 2, axis=0)
+        if 'mse' in metrics:
+            scores['mse'] = residual_ss / n_samples
+        if 'r2' in metrics:
+            scores['r2'] = 1 - residual_ss / y_true_ss
+
+    if is_single:
+        scores = {metric: float(score[0]) for metric, score in scores.items()}
 
-    return r
+    return scores
+
+
+def segment_scorer(y_true, y_preds, segment_starts, sample_weight=None,
+                   metrics=('r',)):
+    """
+    Scores contiguous segments (E.g. cross-validation test folds) of
+    concatenated predictions using multiple metrics (Pearson r, MSE, r2).
+
+    Every segment and every set of predictions is scored in one vectorized
+    pass with grouped sums (np.add.reduceat). Sample weights give how many
+    times each sample counts, so a bootstrap sample can be scored from the
+    original predictions by weighting each sample by how many times it was
+    drawn.
+
+    Parameters
+    ----------
+    y_true : np.array
+        The targets of all segments (n_samples).
+    y_preds : np.array
+        The predictions (... x n_samples), E.g. one row per training group.
+    segment_starts : np.array
+        Index of the first sample of each segment.
+    sample_weight : np.array, optional
+        The weight of each sample, broadcastable to y_preds with extra leading
+        dimensions (E.g. bootstrap sample x 1 x n_samples).
+    metrics : tuple, optional
+        Any of 'r', 'mse', and 'r2'.
+
+    Returns
+    -------
+    dict
+        Mapping of metric to scores (... x n_segments). Segments where the
+        score is undefined (E.g. no weight) are NaN.
+
+    """
+    # The metrics don't change if the targets and predictions are shifted by
+    # the same amount, so center both on the targets to keep the sums small
+    offset = np.mean(y_true)
+    y_true = np.asarray(y_true, dtype=np.float64) - offset
+    y_preds = np.asarray(y_preds, dtype=np.float64) - offset
+
+    if sample_weight is None:
+        sample_weight = np.ones(y_true.shape)
+    shape = np.broadcast_shapes(y_preds.shape, np.shape(sample_weight))
+
+    def segment_sum(values):
+        return np.add.reduceat(np.broadcast_to(values, shape), segment_starts,
+                               axis=-1)
+
+    scores = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight_sum = segment_sum(sample_weight)
+        true_sum = segment_sum(sample_weight * y_true)
+        true_ss = (segment_sum(sample_weight * y_true ** 2)
+                   - true_sum ** 2 / weight_sum)
+
+        if 'r' in metrics:
+            pred_sum = segment_sum(sample_weight * y_preds)
+            pred_ss = (segment_sum(sample_weight * y_preds ** 2)
+                       - pred_sum ** 2 / weight_sum)
+            cross_ss = (segment_sum(sample_weight * y_true * y_preds)
+                        - true_sum * pred_sum / weight_sum)
+            scores['r'] = np.clip(cross_ss / np.sqrt(true_ss * pred_ss), -1, 1)
+
+        if 'mse' in metrics or 'r2' in metrics:
+            residual_ss = segment_sum(sample_weight * (y_true - y_preds) ** 2)
+            if 'mse' in metrics:
+                scores['mse'] = residual_ss / weight_sum
+            if 'r2' in metrics:
+                scores['r2'] = 1 - residual_ss / true_ss
+
+    return scores
 
 
 def calc_pvalue(permutation_scores, score, n_permutations):
@@ -84,3 +220,175 @@ def calc_pvalue(permutation_scores, score, n_permutations):
 
     """
     return (np.sum(permutation_scores >= score) + 1.0) / (n_permutations + 1)
+
+
+def get_permutation_seeds(n_permutations, random_state=None, start=0):
+    """
+    Gets an independent random seed for each permutation.
+
+    Permutation i always gets the same seed for a given random_state,
+    regardless of how the permutations are split between workers or runs,
+    so permutation tests are reproducible.
+
+    Parameters
+    ----------
+    n_permutations : int
+    random_state : int, optional
+        If None, fresh entropy is used (not reproducible).
+    start : int, optional
+        Index of the first permutation, used to continue a previous run.
+
+    Returns
+    -------
+    list
+        A list of np.random.SeedSequence, one per permutation. Pass to
+        np.random.default_rng() to get each permutation's generator.
+
+    """
+    if random_state is None:
+        random_state = np.random.SeedSequence().entropy
+
+    return [np.random.SeedSequence(random_state, spawn_key=(perm,))
+            for perm in range(start, start + n_permutations)]
+
+
+def get_n_chunks(n_items, n_jobs=None, chunks_per_job=4):
+    """
+    Gets the number of chunks to split work between joblib workers, a few
+    per worker so faster workers can take on more of the chunks.
+
+    Parameters
+    ----------
+    n_items : int
+        Number of items (E.g. permutations or bootstrap samples) to split.
+    n_jobs : int, optional
+        Passed to joblib, -1 means all processors.
+    chunks_per_job : int, optional
+
+    Returns
+    -------
+    int
+        Between 1 and n_items chunks.
+
+    Examples
+    --------
+    >>> seed_chunks = np.array_split(np.array(seeds, dtype=object),
+    ...                              get_n_chunks(len(seeds), n_jobs))
+
+    """
+    return min(n_items, max(1, effective_n_jobs(n_jobs) * chunks_per_job))
+
+
+def sequential_permutation_test(
+        score_permutations, true_scores, max_permutations=N_PERM, alpha=0.05,
+        batch_size=50, h=10, confidence=0.99, random_state=None):
+    """
+    Runs a permutation test in batches and stops once every p-value is
+    resolved relative to alpha, instead of always running max_permutations.
+
+    A score's p-value is resolved once either h permutation scores are at
+    least as high as the true score (Besag & Clifford, 1991), or the
+    Clopper-Pearson confidence interval of its p-value no longer contains
+    alpha. Scores that are clearly non-significant or clearly significant
+    stop early, and only borderline scores run all permutations. Once a
+    score is resolved, later batches don't change its p-value.
+
+    Parameters
+    ----------
+    score_permutations : function
+        Scores the permutations for a list of seeds (see
+        get_permutation_seeds()), returning an array with the same shape as
+        true_scores plus a last permutation axis.
+    true_scores : float or np.array
+    max_permutations : int, optional
+    alpha : float, optional
+    batch_size : int, optional
+    h : int, optional
+        Number of permutation scores at least as high as the true score
+        needed to stop early.
+    confidence : float, optional
+        Confidence level of the p-value's confidence interval.
+    random_state : int, optional
+
+    Returns
+    -------
+    permutation_scores : np.array
+        All permutation scores that were run, permutations on the last axis.
+    pvalues : np.array
+    n_permutations : np.array
+        The number of permutations each p-value is based on.
+
+    References
+    ----------
+    Besag, J., & Clifford, P. (1991). Sequential Monte Carlo p-values.
+    Biometrika, 78(2), 301-304.
+
+    """
+    true_scores = np.asarray(true_scores, dtype=float)
+    if random_state is None:
+        random_state = np.random.SeedSequence().entropy
+
+    n_exceed = np.zeros(true_scores.shape, dtype=int)
+    n_permutations = np.zeros(true_scores.shape, dtype=int)
+    pvalues = np.full(true_scores.shape, np.nan)
+    permutation_scores = []
+    n_done = 0
+
+    while n_done < max_permutations and np.any(n_permutations == 0):
+        n_batch = min(batch_size, max_permutations - n_done)
+        seeds = get_permutation_seeds(n_batch, random_state, n_done)
+        batch_scores = np.asarray(score_permutations(seeds))
+        permutation_scores.append(batch_scores)
+        n_done += n_batch
+
+        # Only count the permutations of scores that haven't been resolved
+        active = n_permutations == 0
+        batch_exceed = np.sum(batch_scores >= true_scores[..., np.newaxis], axis=-1)
+        n_exceed[active] += batch_exceed[active]
+
+        lower, upper = _calc_pvalue_interval(n_exceed, n_done, confidence)
+        stop_large = active & (n_exceed >= h)
+        stop_resolved = active & ~stop_large & ((lower > alpha) | (upper < alpha))
+
+        pvalues[stop_large] = n_exceed[stop_large] / n_done
+        pvalues[stop_resolved] = (n_exceed[stop_resolved] + 1.0) / (n_done + 1)
+        n_permutations[stop_large | stop_resolved] = n_done
+
+    # Unresolved scores use all permutations
+    unresolved = n_permutations == 0
+    pvalues[unresolved] = (n_exceed[unresolved] + 1.0) / (n_done + 1)
+    n_permutations[unresolved] = n_done
+
+    return np.concatenate(permutation_scores, axis=-1), pvalues, n_permutations
+
+
+def _calc_pvalue_interval(n_exceed, n_permutations, confidence):
+    """
+    Calculates the Clopper-Pearson confidence interval of permutation
+    p-values.
+
+    Helper function for sequential_permutation_test().
+
+    Parameters
+    ----------
+    n_exceed : np.array
+        Number of permutation scores at least as high as the true score.
+    n_permutations : int
+    confidence : float
+
+    Returns
+    -------
+    tuple
+        The lower and upper bounds.
+
+    """
+    tail = (1 - confidence) / 2
+    n_below = n_permutations - n_exceed
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lower = np.where(
+            n_exceed == 0, 0, stats.beta.ppf(tail, n_exceed, n_below + 1))
+        upper = np.where(
+            n_below == 0, 1, stats.beta.ppf(1 - tail, n_exceed + 1, n_below))
+
+    return lower, upper
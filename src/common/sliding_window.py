@@ -0,0 +1,225 @@
+"""
+Holds the functions for modeling sliding age windows with ridge regression,
+updating the kernel incrementally as subjects enter and leave the window.
+"""
+import numpy as np
+
+from common.binning import get_sliding_windows
+from common.scoring import batch_scorer
+
+
+class SlidingWindowKernel:
+    """
+    Class keeping the linear kernel (Gram matrix, X X^T) of the subjects in
+    a sliding window over the age-sorted subjects.
+
+    Moving the window only computes the kernel rows of the subjects that
+    enter it, and the rows of subjects that leave are dropped, so the kernel
+    of every window isn't recomputed from scratch. Only the window's samples
+    are kept in memory, never a sorted copy of X.
+    """
+    def __init__(self, X, order, feature_scale=None):
+        """
+        Initializes an empty window.
+
+        Parameters
+        ----------
+        X : np.array
+            The samples of all subjects, in any order.
+        order : np.array
+            Indices that sort the subjects by age.
+        feature_scale : np.array, optional
+            Value to divide each feature by (E.g. its standard deviation)
+            before computing the kernel.
+
+        """
+        self.X = X
+        self.order = order
+        self.feature_scale = feature_scale
+        self.start, self.end = 0, 0
+        self.kernel = np.zeros((0, 0))
+        self._X_window = np.zeros((0, X.shape[1]), dtype=X.dtype)
+
+    def update(self, start, end):
+        """
+        Moves the window to the given run of the age-sorted subjects.
+
+        Parameters
+        ----------
+        start : int
+        end : int
+
+        Returns
+        -------
+        np.array
+            The kernel of the window's subjects, in age order.
+
+        """
+        # Keep the overlap with the previous window
+        keep_start, keep_end = max(start, self.start), min(end, self.end)
+        if keep_start >= keep_end:
+            keep_start = keep_end = start
+        keep = slice(keep_start - self.start, keep_end - self.start)
+        kernel, X_window = self.kernel[keep, keep], self._X_window[keep]
+
+        # Add the subjects entering at either end
+        X_before = self._get_rows(start, keep_start)
+        X_after = self._get_rows(keep_end, end)
+        X_new = np.concatenate([X_before, X_after])
+        X_all = np.concatenate([X_before, X_window, X_after])
+
+        new_rows = X_new @ X_all.T
+        n_before = len(X_before)
+        new_index = np.r_[0:n_before, n_before + len(X_window):len(X_all)]
+        self.kernel = np.zeros((len(X_all), len(X_all)))
+        kept = slice(n_before, n_before + len(X_window))
+        self.kernel[kept, kept] = kernel
+        self.kernel[new_index] = new_rows
+        self.kernel[:, new_index] = new_rows.T
+
+        self.start, self.end = start, end
+        self._X_window = X_all
+
+        return self.kernel
+
+    def _get_rows(self, start, end):
+        """
+        Gets the (scaled) samples of a run of the age-sorted subjects.
+
+        Parameters
+        ----------
+        start : int
+        end : int
+
+        Returns
+        -------
+        np.array
+
+        """
+        rows = self.X[self.order[start:end]]
+
+        if self.feature_scale is not None:
+            rows = rows / self.feature_scale
+
+        return rows
+
+
+def sliding_window_ridge_scores(
+        X, y, ages, cv, alphas=(1.0,), window_size=3, step=1, metric='r',
+        scale=True, min_age=None, max_age=None):
+    """
+    Cross-validates ridge regression in every sliding age window, updating
+    the kernel incrementally between windows.
+
+    Each window's cross folds are fit in the dual (kernel) form, with the
+    kernel centered on the training fold, which is the same as
+    sklearn.linear_model.Ridge(alpha, fit_intercept=True) on the (scaled)
+    samples. All alphas share one eigendecomposition per fold.
+
+    Parameters
+    ----------
+    X : np.array
+    y : np.array
+    ages : np.array
+    cv : sklearn.cross_validation instance
+    alphas : list, optional
+    window_size : float, optional
+        See get_sliding_windows().
+    step : float, optional
+        See get_sliding_windows().
+    metric : str, optional
+        Any metric of batch_scorer() ('r', 'mse', or 'r2').
+    scale : bool, optional
+        Whether to divide each feature by its standard deviation across all
+        subjects first. A StandardScaler fit in each window would change the
+        kernel of every subject, so it can't be updated incrementally.
+    min_age : float, optional
+    max_age : float, optional
+
+    Returns
+    -------
+    windows : list
+        List of AgeBin for each window, see get_sliding_windows().
+    scores : np.array
+        The average score across all cross folds (window x alpha), NaN for
+        windows too small to split.
+
+    Examples
+    --------
+    >>> windows, scores = sliding_window_ridge_scores(
+    ...     X, y, ages, RKF_10_10, alphas=np.arange(1, 10001, 100), step=0.5)
+    >>> [window.label for window in windows], scores.max(axis=1)
+
+    """
+    y = np.asarray(y, dtype=np.float64)
+    alphas = np.asarray(alphas, dtype=np.float64)
+    windows, window_bounds = get_sliding_windows(ages, window_size, step,
+                                                 min_age, max_age)
+
+    feature_scale = None
+    if scale:
+        feature_scale = X.std(axis=0)
+        feature_scale[feature_scale == 0] = 1
+
+    kernel = SlidingWindowKernel(X, np.argsort(ages, kind='stable'),
+                                 feature_scale)
+    scores = np.full((len(windows), len(alphas)), np.nan)
+
+    for window_num, (window, (start, end)) in enumerate(
+            zip(windows, window_bounds)):
+        window_kernel = kernel.update(start, end)
+        if len(window) < cv.get_n_splits():
+            continue
+
+        scores[window_num] = _kernel_ridge_cv_scores(
+            window_kernel, y[window.indices], cv, alphas, metric)
+
+    return windows, scores
+
+
+def _kernel_ridge_cv_scores(kernel, y, cv, alphas, metric):
+    """
+    Cross-validates ridge regression from a precomputed linear kernel.
+
+    Helper function for sliding_window_ridge_scores().
+
+    Parameters
+    ----------
+    kernel : np.array
+        The linear kernel of the samples (samples x samples).
+    y : np.array
+    cv : sklearn.cross_validation instance
+    alphas : np.array
+    metric : str
+
+    Returns
+    -------
+    np.array
+        The average score across all cross folds for each alpha.
+
+    """
+    fold_scores = []
+
+    for train, test in cv.split(y):
+        train_kernel = kernel[np.ix_(train, train)]
+        test_kernel = kernel[np.ix_(test, train)]
+
+        # Center both kernels on the training samples' mean
+        train_mean = train_kernel.mean(axis=0)
+        centered_train = (train_kernel - train_mean[:, np.newaxis]
+                          - train_mean[np.newaxis, :] + train_mean.mean())
+        centered_test = (test_kernel - test_kernel.mean(axis=1)[:, np.newaxis]
+                         - train_mean[np.newaxis, :] + train_mean.mean())
+
+        # Dual ridge solution for all alphas: (K + alpha * I)^-1 y
+        y_offset = y[train].mean()
+        eigvals, eigvecs = np.linalg.eigh(centered_train)
+        dual_coef = eigvecs @ (
+            (eigvecs.T @ (y[train] - y_offset))[:, np.newaxis] /
+            (eigvals[:, np.newaxis] + alphas))
+
+        y_pred = centered_test @ dual_coef + y_offset
+        fold_scores.append(
+            batch_scorer(y[test], y_pred, metrics=(metric,))[metric])
+
+    return np.mean(fold_scores, axis=0)